@@ -1,32 +1,42 @@
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.utils.translation import ugettext_lazy as _
 from forum.models import Section, Node
-from django.utils.crypto import get_random_string
-from forum.utils import create_thumbnail
+from forum.jobs import enqueue, node_icon_thumbnails
 
 class SectionAdmin(admin.ModelAdmin):
     list_display = ('name', 'order', 'last_modified')
 
+class NodeForm(forms.ModelForm):
+    def clean_icon_raw(self):
+        icon = self.cleaned_data['icon_raw']
+        image = getattr(icon, 'image', None)
+        if image and image.width * image.height > settings.THUMBNAIL_MAX_PIXELS:
+            raise forms.ValidationError(_("The picture is too large"))
+        
+        return icon
+
 class NodeAdmin(admin.ModelAdmin):
+    form = NodeForm
     exclude = ['icon_l', 'icon_m', 'icon_s']
     list_display = ('section', 'name', 'admin_image', 'description', 'order', 'last_modified')
     
     def save_model(self, request, obj, form, change):
         icon = form.cleaned_data['icon_raw']
-        if icon:
+        new_icon = icon and 'icon_raw' in form.changed_data
+        if new_icon:
             self._save_icon(obj, icon)
         
         super(NodeAdmin, self).save_model(request, obj, form, change)
+        if new_icon:
+            enqueue(node_icon_thumbnails, node_id=obj.id, icon=obj.icon_raw.name)
     
     def _save_icon(self, obj, image):
-        new_name = get_random_string(length=6)
-        ext = image.name.split('.')[-1]
-        image.name = '%s.%s' % (new_name, ext)
-        
-        large, medium, small = create_thumbnail(image, new_name, ext)
+        # the thumbnails are made by the runjobs worker, the raw icon is
+        # served until then
         obj.icon_raw = image
-        obj.icon_l = large
-        obj.icon_m = medium
-        obj.icon_s = small
+        obj.icon_l = obj.icon_m = obj.icon_s = None
 
 admin.site.register(Section, SectionAdmin)
 admin.site.register(Node, NodeAdmin)
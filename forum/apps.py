@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ForumConfig(AppConfig):
     name = 'forum'
+
+    def ready(self):
+        # connects the search index signals
+        import forum.search
@@ -0,0 +1,118 @@
+import os
+import json
+import uuid
+import logging
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from niuauth.models import Avatar, Notification
+from niuauth.utils import user_reward
+from forum.models import Node, Topic, Reply, Job
+from forum.utils import notify_users, create_thumbnail
+
+logger = logging.getLogger(__name__)
+
+def enqueue(func, delay=0, **kwargs):
+    """
+    Queue func(**kwargs) to run in the ``runjobs`` worker. func must be a
+    module level function and kwargs must be JSON serializable.
+    
+    The job is written in the caller's transaction, so it is only seen by the
+    worker once whatever it refers to has been committed.
+    """
+    name = '%s.%s' % (func.__module__, func.__name__)
+    return Job.objects.create(name=name, kwargs=json.dumps(kwargs),
+                              run_after=timezone.now() + timedelta(seconds=delay))
+
+def _claim(batch_size):
+    now = timezone.now()
+    runnable = Job.objects.filter(failed=False, run_after__lte=now).filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+    ids = list(runnable.values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    
+    # the lock condition is checked again by the UPDATE, a job another worker
+    # claimed in between is left to it
+    token = uuid.uuid4().hex
+    runnable.filter(id__in=ids).update(
+        locked_by=token, locked_until=now + timedelta(seconds=settings.JOB_LEASE))
+    
+    return list(Job.objects.filter(locked_by=token))
+
+def _run(job):
+    try:
+        func = import_string(job.name)
+        with transaction.atomic():
+            func(**json.loads(job.kwargs))
+            job.delete()
+    except Exception:
+        attempts = job.attempts + 1
+        failed = attempts >= settings.JOB_MAX_ATTEMPTS
+        delay = settings.JOB_RETRY_DELAY * 2 ** (attempts - 1)
+        Job.objects.filter(id=job.id).update(
+            attempts=attempts, failed=failed, error=traceback.format_exc(),
+            run_after=timezone.now() + timedelta(seconds=delay),
+            locked_by=None, locked_until=None)
+        logger.exception("job %s failed, attempt %d", job, attempts)
+        return False
+    
+    return True
+
+def run_jobs(batch_size=None):
+    """
+    Run one batch of due jobs, return (done, failed). A failing job is retried
+    with exponential backoff, after JOB_MAX_ATTEMPTS attempts it is marked
+    failed and kept for inspection.
+    """
+    done = failed = 0
+    for job in _claim(batch_size or settings.JOB_BATCH_SIZE):
+        if _run(job):
+            done += 1
+        else:
+            failed += 1
+    
+    return done, failed
+
+def notify_topic(topic_id, user_ids):
+    topic = Topic.objects.only('author_id').get(id=topic_id)
+    notify_users(user_ids, Notification.MENTION_TOPIC, topic.author_id, topic.id)
+
+def notify_reply(reply_id, user_ids):
+    reply = Reply.objects.only('author_id', 'topic_id').get(id=reply_id)
+    notify_users(user_ids, Notification.MENTION_REPLY, reply.author_id, reply.topic_id, reply.id)
+
+def reward_topic_reply(topic_id):
+    # only the job that flips reply_reward pays, a duplicate is a no-op
+    if Topic.objects.filter(id=topic_id, reply_reward=False, reply_count__gte=10).update(reply_reward=True):
+        topic = Topic.objects.select_related('author__profile').get(id=topic_id)
+        user_reward(topic.author, settings.REP_TOPIC_REPLY, topic_id=topic.id)
+
+def _thumbnails(raw):
+    new_name, ext = os.path.splitext(os.path.basename(raw.name))
+    src = raw.storage.open(raw.name)
+    try:
+        return create_thumbnail(src, new_name, ext.lstrip('.'))
+    finally:
+        src.close()
+
+def avatar_thumbnails(avatar_id):
+    avatar = Avatar.objects.get(id=avatar_id)
+    if avatar.avatar_s:
+        return
+    
+    avatar.avatar_l, avatar.avatar_m, avatar.avatar_s = _thumbnails(avatar.avatar_raw)
+    avatar.save(update_fields=['avatar_l', 'avatar_m', 'avatar_s'])
+
+def node_icon_thumbnails(node_id, icon):
+    # an icon replaced while the job was queued is left to its own job
+    node = Node.objects.get(id=node_id)
+    if node.icon_raw.name != icon or node.icon_s:
+        return
+    
+    node.icon_l, node.icon_m, node.icon_s = _thumbnails(node.icon_raw)
+    node.save(update_fields=['icon_l', 'icon_m', 'icon_s'])
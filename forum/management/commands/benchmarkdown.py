@@ -0,0 +1,60 @@
+import time
+from django.core.management.base import BaseCommand
+from forum import mismd
+
+SNIPPETS = [
+    ('python', 'def fib(n):\n    a, b = 0, 1\n    for _i in range(n):\n        a, b = b, a + b\n    return a\n'),
+    ('javascript', 'function fib(n) {\n  var a = 0, b = 1;\n  while (n--) { var t = a; a = b; b = t + b; }\n  return a;\n}\n'),
+    ('c', 'int fib(int n) {\n    int a = 0, b = 1;\n    while (n--) { int t = a; a = b; b += t; }\n    return a;\n}\n'),
+    ('sql', 'SELECT id, title FROM forum_topic WHERE node_id = 1 ORDER BY rank DESC LIMIT 20;\n'),
+    ('bash', 'for f in *.py; do\n  python -m py_compile "$f" || exit 1\ndone\n'),
+    ('nosuchlang', 'this language is unknown to pygments\n'),
+]
+
+def code_heavy_post(i, blocks):
+    parts = ['# post %d' % i, 'Some text before the code.']
+    for j in range(blocks):
+        lang, code = SNIPPETS[(i + j) % len(SNIPPETS)]
+        parts.append('```%s\n%s```' % (lang, code))
+        parts.append('and a line between blocks %d.' % j)
+
+    return '\n\n'.join(parts)
+
+class Command(BaseCommand):
+    help = 'compare markdown render throughput with and without the lexer/formatter registry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=200)
+        parser.add_argument('--blocks', type=int, default=6)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def _run(self, corpus, repeat):
+        best = None
+        for _i in range(repeat):
+            start = time.perf_counter()
+            for md in corpus:
+                # bypass the render cache, this measures the pipeline itself
+                mismd.mdp(md)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        return best
+
+    def handle(self, *args, **options):
+        corpus = [code_heavy_post(i, options['blocks']) for i in range(options['posts'])]
+
+        cached_lexer, cached_formatter = mismd.get_lexer, mismd.get_formatter
+        mismd.get_lexer = cached_lexer.__wrapped__
+        mismd.get_formatter = cached_formatter.__wrapped__
+        try:
+            uncached = self._run(corpus, options['repeat'])
+        finally:
+            mismd.get_lexer, mismd.get_formatter = cached_lexer, cached_formatter
+
+        cached = self._run(corpus, options['repeat'])
+
+        count = len(corpus)
+        self.stdout.write("%d posts, %d code blocks each" % (count, options['blocks']))
+        self.stdout.write("uncached: %.3fs  %.1f posts/s" % (uncached, count / uncached))
+        self.stdout.write("cached:   %.3fs  %.1f posts/s" % (cached, count / cached))
+        self.stdout.write("speedup:  %.2fx" % (uncached / cached))
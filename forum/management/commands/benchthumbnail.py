@@ -0,0 +1,80 @@
+import time
+import resource
+import multiprocessing
+import django
+from io import BytesIO
+from PIL import Image, ImageOps
+from django.core.management.base import BaseCommand
+from django.core.files.uploadedfile import SimpleUploadedFile
+from forum.utils import create_thumbnail, IMAGE_LARGE, IMAGE_MEDIUM, IMAGE_SMALL
+
+CASES = [
+    ('jpeg', 'jpg', (5472, 3648)),
+    ('jpeg', 'jpg', (4000, 3000)),
+    ('png', 'png', (3000, 2000)),
+    ('gif', 'gif', (2000, 2000)),
+]
+
+def make_image(fmt, size):
+    # a gradient with noise, so the encoders have real work to do
+    img = Image.linear_gradient('L').resize(size)
+    img = Image.merge('RGB', (img, img.transpose(Image.FLIP_LEFT_RIGHT), Image.effect_noise(size, 40)))
+    if fmt == 'gif':
+        img = img.convert('P', palette=Image.ADAPTIVE)
+    
+    data = BytesIO()
+    img.save(data, fmt)
+    
+    return data.getvalue()
+
+def legacy_thumbnail(src, new_name, ext):
+    # what create_thumbnail did before: a full decode, then a fit from the
+    # full size source for every size
+    upload = Image.open(BytesIO(src.read()))
+    fmt = src.content_type.split('/')[-1]
+    files = []
+    for size, suffix in ((IMAGE_LARGE, 'l'), (IMAGE_MEDIUM, 'm'), (IMAGE_SMALL, 's')):
+        img = ImageOps.fit(upload, (size, size), Image.LANCZOS)
+        temp = BytesIO()
+        img.save(temp, fmt, quality=95)
+        files.append(SimpleUploadedFile("%s_%s.%s" % (new_name, suffix, ext), temp.getvalue()))
+    
+    return files
+
+def _measure(args):
+    pipeline, fmt, ext, data, repeat = args
+    upload = SimpleUploadedFile('bench.%s' % ext, data, content_type='image/%s' % fmt)
+    func = legacy_thumbnail if pipeline == 'legacy' else create_thumbnail
+    
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _i in range(repeat):
+        upload.seek(0)
+        start = time.perf_counter()
+        func(upload, 'bench', ext)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    
+    return best, peak / 1024.0
+
+class Command(BaseCommand):
+    help = 'compare thumbnail latency and peak memory of the legacy and current pipelines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        # every measurement runs in a fresh process so peak memory is its own,
+        # inputs are made in a child too: a process started from this one
+        # inherits its peak
+        ctx = multiprocessing.get_context('forkserver')
+        self.stdout.write("%-6s %-11s %-8s %10s %10s" % ('format', 'size', 'pipeline', 'latency', 'peak'))
+        for fmt, ext, size in CASES:
+            with ctx.Pool(1, initializer=django.setup) as pool:
+                data = pool.apply(make_image, (fmt, size))
+            for pipeline in ('legacy', 'current'):
+                with ctx.Pool(1, initializer=django.setup) as pool:
+                    best, peak = pool.apply(_measure, ((pipeline, fmt, ext, data, options['repeat']),))
+                self.stdout.write("%-6s %-11s %-8s %8.1fms %8.1fMB" % (
+                    fmt, '%dx%d' % size, pipeline, best * 1000, peak))
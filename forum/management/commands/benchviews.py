@@ -0,0 +1,119 @@
+import re
+import json
+import math
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import RegexURLPattern, get_resolver, reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from forum.models import Node, Topic
+
+# requests that need a body, POST ones must leave the data as it was
+REQUEST_DATA = {
+    'render_markdown_view': ('POST', {'md': '# title\n\n```python\nprint("niu")\n```\n'}),
+    'search_view': ('GET', {'q': 'seeded'}),
+}
+# views that change data on every request are left out
+SKIP = set(['reply_topic_view', 'like_topic_view', 'watch_node_view', 'clear_notification_view'])
+
+def percentile(values, p):
+    # nearest rank: the smallest value with at least p% of the values at or below it
+    ranked = sorted(values)
+    return ranked[max(0, math.ceil(p / 100.0 * len(ranked)) - 1)]
+
+class Command(BaseCommand):
+    help = 'request every url of niuforum/urls.py and report latency percentiles and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20, help='timed requests per url')
+        parser.add_argument('--user', default=None,
+                            help='log in as this user, defaults to the author of the busiest topic')
+        parser.add_argument('--anonymous', action='store_true')
+        parser.add_argument('--filter', default=None, help='only urls whose name matches this regex')
+        parser.add_argument('--json', default=None, help='write the report to this file, - for stdout')
+
+    def _samples(self, user):
+        topic = Topic.objects.order_by('-reply_count', 'id').first()
+        node = Node.objects.order_by('id').first()
+        if topic is None or node is None:
+            raise CommandError("no topics to request, run seedforum first")
+
+        return {'topic_id': topic.id, 'node_id': node.id, 'user_id': user.username,
+                'filter': 'default', 'period': 'week'}
+
+    def _urls(self, samples, name_filter):
+        for pattern in get_resolver().url_patterns:
+            # included url confs, like admin and accounts, are not ours
+            if not isinstance(pattern, RegexURLPattern) or not pattern.name:
+                continue
+            if pattern.name in SKIP or (name_filter and not re.search(name_filter, pattern.name)):
+                continue
+
+            kwargs = dict((k, samples[k]) for k in pattern.regex.groupindex)
+            # a name can route several patterns, the arguments tell them apart
+            label = pattern.name + (':' + ','.join(sorted(kwargs)) if kwargs else '')
+            method, data = REQUEST_DATA.get(pattern.name, ('GET', {}))
+            yield label, reverse(pattern.name, kwargs=kwargs), method, data
+
+    def _measure(self, client, url, method, data, count):
+        request = client.post if method == 'POST' else client.get
+        # the first request fills caches, it is not timed
+        status = request(url, data).status_code
+
+        latencies = []
+        queries = []
+        for _i in range(count):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                request(url, data)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+
+        return {
+            'url': url,
+            'method': method,
+            'status': status,
+            'requests': count,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'queries_min': min(queries),
+            'queries_max': max(queries),
+        }
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user = User.objects.get(username=options['user'])
+        else:
+            user = Topic.objects.order_by('-reply_count', 'id').select_related('author').first()
+            user = user.author if user else User.objects.order_by('id').first()
+        if user is None:
+            raise CommandError("no users, run seedforum first")
+
+        host = next((h for h in settings.ALLOWED_HOSTS if not h.startswith('.') and h != '*'), 'localhost')
+        client = Client(HTTP_HOST=host)
+        if not options['anonymous']:
+            client.force_login(user)
+
+        report = {}
+        for label, url, method, data in self._urls(self._samples(user), options['filter']):
+            report[label] = self._measure(client, url, method, data, options['requests'])
+
+        if options['json']:
+            if options['json'] == '-':
+                self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            else:
+                with open(options['json'], 'w') as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+            return
+
+        self.stdout.write("%-36s %6s %9s %9s %9s %9s" % ('view', 'status', 'p50', 'p95', 'p99', 'queries'))
+        for label in sorted(report):
+            r = report[label]
+            queries = '%d' % r['queries_min'] if r['queries_min'] == r['queries_max'] else \
+                      '%d-%d' % (r['queries_min'], r['queries_max'])
+            self.stdout.write("%-36s %6d %7.1fms %7.1fms %7.1fms %9s" % (
+                label, r['status'], r['p50_ms'], r['p95_ms'], r['p99_ms'], queries))
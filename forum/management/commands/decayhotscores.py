@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q, Min, Max
+from django.utils import timezone
+from forum.models import Topic
+
+class Command(BaseCommand):
+    help = 'decay the hot scores of the default topic order, run every HOT_SCORE_DECAY_INTERVAL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='score every topic again from its counters and age')
+        parser.add_argument('--chunk', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            count = self._rebuild(options['chunk'])
+            self.stdout.write("%d topics scored" % count)
+            return
+
+        decayed, zeroed = self._decay(options['chunk'])
+        self.stdout.write("%d topics decayed, %d zeroed" % (decayed, zeroed))
+
+    def _decay(self, chunk_size):
+        # only scores still worth something are written, the rest of the
+        # table is left alone
+        live = Q(hot_score__gt=settings.HOT_SCORE_MIN) | Q(hot_score__lt=-settings.HOT_SCORE_MIN)
+        bounds = Topic.objects.aggregate(low=Min('id'), high=Max('id'))
+        decayed = zeroed = 0
+        if bounds['low'] is None:
+            return decayed, zeroed
+
+        # the score can't narrow the scan, a range of ids per transaction
+        # keeps the write lock short for the requests posting meanwhile
+        for low in range(bounds['low'], bounds['high'] + 1, chunk_size):
+            topics = Topic.objects.filter(id__gte=low, id__lt=low + chunk_size)
+            with transaction.atomic():
+                zeroed += topics.exclude(live).exclude(hot_score=0).update(hot_score=0)
+                decayed += topics.filter(live).update(hot_score=F('hot_score') * settings.HOT_SCORE_DECAY)
+
+        return decayed, zeroed
+
+    def _rebuild(self, chunk_size):
+        now = timezone.now()
+        count = 0
+        last = 0
+        while True:
+            rows = list(Topic.objects.filter(id__gt=last).order_by('id').values_list(
+                'id', 'reply_count', 'like_count', 'viewed', 'date_created', 'last_replied')[:chunk_size])
+            if not rows:
+                break
+            last = rows[-1][0]
+
+            with transaction.atomic():
+                for topic_id, replies, likes, viewed, created, replied in rows:
+                    # as if all of the activity had happened at the last reply
+                    score = (settings.HOT_SCORE_TOPIC + replies * settings.HOT_SCORE_REPLY +
+                             likes * settings.HOT_SCORE_LIKE + viewed * settings.HOT_SCORE_VIEW)
+                    age = (now - (replied or created)).total_seconds()
+                    score *= settings.HOT_SCORE_DECAY ** (age / settings.HOT_SCORE_DECAY_INTERVAL)
+                    if score < settings.HOT_SCORE_MIN:
+                        score = 0
+                    Topic.objects.filter(id=topic_id).update(hot_score=score)
+            count += len(rows)
+
+        return count
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+from forum.viewcounter import CacheViewCounter, view_counter
+
+class Command(BaseCommand):
+    help = 'write buffered topic views back to the database'
+
+    def handle(self, *args, **options):
+        # views buffered in a web process are out of this process's reach
+        if not isinstance(view_counter, CacheViewCounter):
+            raise CommandError("views are buffered in each web process, set VIEW_COUNTER_CACHE "
+                               "to a shared cache to flush them from here")
+
+        flushed = view_counter.flush()
+        self.stdout.write("%d views flushed" % flushed)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from forum import search
+
+class Command(BaseCommand):
+    help = 'rebuild the full text search index of topics and replies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError("full text search needs the sqlite backend")
+        
+        search.create_index()
+        count = search.rebuild(options['chunk'])
+        self.stdout.write("%d posts indexed" % count)
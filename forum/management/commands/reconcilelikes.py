@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F
+from forum.models import Topic
+
+class Command(BaseCommand):
+    help = 'recount Topic.like_count from the likers of every topic'
+
+    def handle(self, *args, **options):
+        drifted = Topic.objects.annotate(n=Count('liker')).exclude(like_count=F('n')) \
+                               .values_list('id', 'n')
+        fixed = 0
+        for topic_id, n in list(drifted):
+            fixed += Topic.objects.filter(id=topic_id).update(like_count=n)
+        
+        self.stdout.write("%d topics fixed" % fixed)
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from forum.jobs import run_jobs
+
+class Command(BaseCommand):
+    help = 'run queued notification and reward jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='run the due jobs and exit')
+        parser.add_argument('--batch', type=int, default=None)
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = run_jobs(options['batch'])
+            if done or failed:
+                self.stdout.write("%d jobs done, %d failed" % (done, failed))
+            
+            if options['once'] and not (done or failed):
+                break
+            if not (done or failed):
+                time.sleep(options['sleep'])
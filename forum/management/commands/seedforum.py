@@ -0,0 +1,183 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from collections import Counter, defaultdict
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from niuauth.models import UserProfile, Notification
+from forum.models import Section, Node, Topic, Reply
+from forum import search
+
+MARKDOWN = "A seeded topic body with `code`, a [link](http://niutool.com) and a list:\n\n* one\n* two\n"
+CONTENT = ('<p>A seeded topic body with <code>code</code>, a <a href="http://niutool.com">link</a> '
+           'and a list:</p>\n<ul>\n<li>one</li>\n<li>two</li>\n</ul>\n')
+
+@contextmanager
+def explicit_dates(model, *names):
+    # bulk_create would stamp every row with now, the dates are spread instead
+    fields = [model._meta.get_field(name) for name in names]
+    saved = [(f.auto_now, f.auto_now_add) for f in fields]
+    for f in fields:
+        f.auto_now = f.auto_now_add = False
+    try:
+        yield
+    finally:
+        for f, (auto_now, auto_now_add) in zip(fields, saved):
+            f.auto_now, f.auto_now_add = auto_now, auto_now_add
+
+def new_ids(model, before):
+    return list(model.objects.filter(id__gt=before).order_by('id').values_list('id', flat=True))
+
+def last_id(model):
+    return model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+class Command(BaseCommand):
+    help = 'fill the database with a large synthetic forum for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--sections', type=int, default=4)
+        parser.add_argument('--nodes', type=int, default=5, help='nodes per section')
+        parser.add_argument('--topics', type=int, default=10000)
+        parser.add_argument('--replies', type=int, default=10, help='average replies per topic')
+        parser.add_argument('--likes', type=int, default=3, help='average likes per topic')
+        parser.add_argument('--watchers', type=int, default=20, help='average watchers per node')
+        parser.add_argument('--notifications', type=int, default=20, help='average notifications per user')
+        parser.add_argument('--days', type=int, default=365, help='spread the dates over this many days')
+        parser.add_argument('--batch', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-search', action='store_true', help='do not rebuild the search index')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch = options['batch']
+        self.now = timezone.now()
+        self.span = options['days'] * 24 * 3600
+
+        users = self._users(options['users'])
+        nodes = self._nodes(options['sections'], options['nodes'])
+        self._watchers(nodes, users, options['watchers'])
+        topics = self._topics(options['topics'], nodes, users, options['replies'], options['likes'])
+        replies = self._replies(topics, users)
+        likes = self._likes(topics, users)
+        notifications = self._notifications(users, [t[0] for t in topics], replies, options['notifications'])
+
+        self.stdout.write("%d users, %d nodes, %d topics, %d replies, %d likes, %d notifications" % (
+            len(users), len(nodes), len(topics), len(replies), likes, notifications))
+
+        call_command('decayhotscores', rebuild=True, stdout=self.stdout)
+        if not options['no_search']:
+            self.stdout.write("%d rows indexed for search" % search.rebuild())
+
+    def _date(self):
+        return self.now - timedelta(seconds=self.random.randint(0, self.span))
+
+    def _users(self, count):
+        before = last_id(User)
+        # names carry the first new id so seeding twice never collides
+        User.objects.bulk_create([User(username='seed%d_%d' % (before, i), password='!')
+                                  for i in range(count)], self.batch)
+        ids = new_ids(User, before)
+        UserProfile.objects.bulk_create([UserProfile(user_id=user_id, reputation=self.random.randint(0, 500))
+                                         for user_id in ids], self.batch)
+        return ids
+
+    def _nodes(self, sections, per_section):
+        before = last_id(Node)
+        for i in range(sections):
+            section = Section.objects.create(name='seed%d section %d' % (before, i), order=i)
+            Node.objects.bulk_create([Node(section=section, name='seed%d node %d.%d' % (before, i, j),
+                                           description='seeded node', order=j)
+                                      for j in range(per_section)], self.batch)
+        return new_ids(Node, before)
+
+    def _watchers(self, nodes, users, average):
+        through = Node.watcher.through
+        rows = set()
+        for node_id in nodes:
+            for user_id in self.random.sample(users, min(len(users), average)):
+                rows.add((node_id, user_id))
+        through.objects.bulk_create([through(node_id=n, user_id=u) for n, u in rows], self.batch)
+
+    def _topics(self, count, nodes, users, replies, likes):
+        # the replies and likes of every topic are decided first, so the
+        # counters go in with the topic rather than in an UPDATE per topic
+        before = last_id(Topic)
+        topics = []
+        plans = []
+        for i in range(count):
+            date = self._date()
+            age = (self.now - date).total_seconds()
+            reply_dates = sorted(date + timedelta(seconds=self.random.uniform(0, age))
+                                 for _j in range(self.random.randint(0, 2 * replies)))
+            n_likes = min(len(users), self.random.randint(0, 2 * likes))
+            topics.append(Topic(node_id=self.random.choice(nodes), author_id=self.random.choice(users),
+                                title='seeded topic %d' % i, markdown=MARKDOWN, content=CONTENT,
+                                abstract=MARKDOWN[:60], date_created=date, last_modified=date,
+                                viewed=self.random.randint(0, 1000), reply_count=len(reply_dates),
+                                like_count=n_likes, last_replied=reply_dates[-1] if reply_dates else None,
+                                admin_star=self.random.random() < 0.05))
+            plans.append((reply_dates, n_likes))
+        with explicit_dates(Topic, 'date_created', 'last_modified'):
+            Topic.objects.bulk_create(topics, self.batch)
+
+        return list(zip(new_ids(Topic, before), plans))
+
+    def _replies(self, topics, users):
+        before = last_id(Reply)
+        replies = []
+        for topic_id, (reply_dates, _n_likes) in topics:
+            for date in reply_dates:
+                replies.append(Reply(topic_id=topic_id, author_id=self.random.choice(users),
+                                     markdown='seeded reply', content='<p>seeded reply</p>\n',
+                                     date_created=date))
+
+        # in date order, so ids follow dates as they do for real replies
+        replies.sort(key=lambda r: r.date_created)
+        with explicit_dates(Reply, 'date_created'):
+            Reply.objects.bulk_create(replies, self.batch)
+
+        return list(Reply.objects.filter(id__gt=before).values_list('id', 'topic_id'))
+
+    def _likes(self, topics, users):
+        # bulk_create sends no m2m_changed, like_count was set with the topic
+        through = Topic.liker.through
+        rows = []
+        for topic_id, (_reply_dates, n_likes) in topics:
+            rows.extend(through(topic_id=topic_id, user_id=u) for u in self.random.sample(users, n_likes))
+        through.objects.bulk_create(rows, self.batch)
+
+        return len(rows)
+
+    def _notifications(self, users, topics, replies, average):
+        if not topics:
+            return 0
+
+        notifications = []
+        for user_id in users:
+            for _i in range(self.random.randint(0, 2 * average)):
+                if replies and self.random.random() < 0.7:
+                    reply_id, topic_id = self.random.choice(replies)
+                    kind = Notification.MENTION_REPLY
+                else:
+                    reply_id, topic_id = None, self.random.choice(topics)
+                    kind = Notification.MENTION_TOPIC
+                notifications.append(Notification(user_id=user_id, kind=kind, actor_id=self.random.choice(users),
+                                                  topic_id=topic_id, reply_id=reply_id, date=self._date(),
+                                                  read=self.random.random() < 0.8))
+        with explicit_dates(Notification, 'date'):
+            Notification.objects.bulk_create(notifications, self.batch)
+
+        # one UPDATE per distinct count rather than one per user
+        unread = Counter(n.user_id for n in notifications if not n.read)
+        batches = defaultdict(list)
+        for user_id, n in unread.items():
+            batches[n].append(user_id)
+        for n, user_ids in batches.items():
+            UserProfile.objects.filter(user_id__in=user_ids).update(unread_count=n)
+
+        return len(notifications)
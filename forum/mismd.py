@@ -1,29 +1,58 @@
 import re
+import time
+import logging
+import hashlib
+import threading
+import multiprocessing
+import django
 import mistune
+from collections import OrderedDict
+from functools import lru_cache
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
+from pygments.util import ClassNotFound
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from forum.profiling import timed
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=256)
+def get_lexer(lang, stripall=True):
+    # unknown languages are cached as None, lookups by alias scan the registry
+    try:
+        return get_lexer_by_name(lang, stripall=stripall)
+    except ClassNotFound:
+        return None
+
+@lru_cache(maxsize=8)
+def get_formatter(inlinestyles=False, linenos=False):
+    return HtmlFormatter(noclasses=inlinestyles, linenos=linenos)
 
 def block_code(text, lang, inlinestyles=False, linenos=False):
     if not lang:
         text = text.strip()
         return u'<pre><code>%s</code></pre>\n' % mistune.escape(text)
 
-    try:
-        lexer = get_lexer_by_name(lang, stripall=True)
-        formatter = HtmlFormatter(
-            noclasses=inlinestyles, linenos=linenos
-        )
-        code = highlight(text, lexer, formatter)
-        if linenos:
-            return '<div class="highlight-wrapper">%s</div>\n' % code
-        return code
-    except:
-        return '<pre class="%s"><code>%s</code></pre>\n' % (
-            lang, mistune.escape(text)
-        )
+    lexer = get_lexer(lang.lower())
+    if lexer is not None:
+        try:
+            code = highlight(text, lexer, get_formatter(bool(inlinestyles), bool(linenos)))
+            if linenos:
+                return '<div class="highlight-wrapper">%s</div>\n' % code
+            return code
+        except Exception:
+            # a lexer that chokes on the text leaves it unhighlighted
+            logger.warning("highlighting %s code failed", lang, exc_info=True)
+    
+    return '<pre class="%s"><code>%s</code></pre>\n' % (
+        lang, mistune.escape(text)
+    )
 
 class HighlightMixin(object):
     def block_code(self, text, lang):
@@ -32,15 +61,54 @@ class HighlightMixin(object):
         linenos = self.options.get('linenos')
         return block_code(text, lang, inlinestyles, linenos)
 
+MENTION_REGEX = re.compile(r'@(\w+)', re.M)
+
+_mentions = threading.local()
+
+def resolve_mentions(md):
+    """
+    Map every @name in md to its User, or None when there is no such user,
+    with a single query.
+    """
+    names = set()
+    for name in MENTION_REGEX.findall(md):
+        # mistune splits text at '_', so the renderer may ask for a prefix
+        parts = name.split('_')
+        names.update('_'.join(parts[:i]) for i in range(1, len(parts)+1))
+    names.discard('')
+    users = dict.fromkeys(names)
+    if names:
+        for u in User.objects.filter(username__in=names):
+            users[u.username] = u
+    
+    # keep it for mentioned_users(), which usually follows the render
+    _mentions.last = (md, users)
+    
+    return users
+
+def mentioned_users(md):
+    last = getattr(_mentions, 'last', None)
+    _mentions.last = None
+    if last is not None and last[0] == md:
+        return last[1]
+    
+    return resolve_mentions(md)
+
 class UserLinkRendererMixin(object):
+    # filled by NiuMarkdown before each render
+    mention_users = None
+    
     def user_link(self, user):
-        try:
-            u = User.objects.get(username=user)
-        except User.DoesNotExist:
-            u = None
+        if self.mention_users is not None and user in self.mention_users:
+            u = self.mention_users[user]
+        else:
+            try:
+                u = User.objects.get(username=user)
+            except User.DoesNotExist:
+                u = None
         
         if u:
-            uurl = reverse('user_profile', kwargs={'user_id':u.username})
+            uurl = reverse('user_profile', kwargs={'user_id':user})
             return "<a class='user niu-link' href='%s'>@%s</a>" % (uurl, user)
         else:
             return "@"+user
@@ -48,7 +116,7 @@ class UserLinkRendererMixin(object):
 class NiuRenderer(HighlightMixin, UserLinkRendererMixin, mistune.Renderer):
     def __init__(self, *args, **kwargs):
         super(NiuRenderer, self).__init__(*args, **kwargs)
-        self.user_link_rule = re.compile(r'@(\w+)', re.M)
+        self.user_link_rule = MENTION_REGEX
     
     def text(self, text):
         new_text = ""
@@ -64,11 +132,240 @@ class NiuRenderer(HighlightMixin, UserLinkRendererMixin, mistune.Renderer):
         
         return new_text
 
+class NiuMarkdown(mistune.Markdown):
+    def parse(self, text):
+        # resolve all mentions up front instead of one query per @name
+        return self.parse_with_mentions(text, resolve_mentions(text))
+    
+    def parse_with_mentions(self, text, mentions):
+        self.renderer.mention_users = mentions
+        try:
+            return super(NiuMarkdown, self).parse(text)
+        finally:
+            self.renderer.mention_users = None
+
+class RenderCache(object):
+    """
+    LRU cache of rendered markdown keyed by a digest of the source and the
+    renderer options, optionally backed by a shared django cache.
+    
+    The output of a text with @mentions depends on which users exist, so its
+    key also carries a mention generation that is bumped whenever users are
+    added, renamed or removed. Only a shared cache holds a generation every
+    process sees, without one such texts are not cached.
+    """
+    def __init__(self, markdown, size=None, cache_alias=None):
+        self.markdown = markdown
+        self._size = size
+        self._cache_alias = cache_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def size(self):
+        return self._size or settings.MARKDOWN_RENDER_CACHE_SIZE
+    
+    @property
+    def shared(self):
+        alias = self._cache_alias or settings.MARKDOWN_RENDER_CACHE
+        if alias:
+            return caches[alias]
+        return None
+    
+    @property
+    def generation(self):
+        shared = self.shared
+        if shared is not None:
+            return shared.get_or_set('forum:md:generation', 0, None)
+        return self._generation
+    
+    def invalidate_mentions(self):
+        shared = self.shared
+        if shared is not None:
+            shared.add('forum:md:generation', 0, None)
+            shared.incr('forum:md:generation')
+        
+        with self._lock:
+            self._generation += 1
+            # local entries of an older generation can never be hit again
+            for key in [k for k in self._entries if k.endswith(':m')]:
+                del self._entries[key]
+    
+    def key(self, md):
+        options = sorted(self.markdown.renderer.options.items())
+        digest = hashlib.sha1(("%r\n" % options).encode('utf-8'))
+        digest.update(md.encode('utf-8'))
+        
+        if self.markdown.renderer.user_link_rule.search(md):
+            # a user saved in another process bumps only that process's counter
+            if self.shared is None:
+                return None
+            return 'forum:md:%s:%d:m' % (digest.hexdigest(), self.generation)
+        return 'forum:md:%s' % digest.hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return rendered
+        
+        shared = self.shared
+        if shared is not None:
+            rendered = shared.get(key)
+            if rendered is not None:
+                self._store(key, rendered)
+                with self._lock:
+                    self.hits += 1
+                return rendered
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key, rendered):
+        self._store(key, rendered)
+        
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, rendered, settings.MARKDOWN_RENDER_CACHE_TIMEOUT)
+    
+    def _store(self, key, rendered):
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+    
+    def render(self, md):
+        key = self.key(md)
+        rendered = self.get(key) if key is not None else None
+        if rendered is None:
+            if render_pool.enabled:
+                rendered, complete = render_pool.render(md)
+            else:
+                rendered, complete = self.markdown(md), True
+            
+            # a fallback is only kept until the next try
+            if complete and key is not None:
+                self.set(key, rendered)
+        
+        return rendered
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+def render_plain(md):
+    return '<p>%s</p>\n' % mistune.escape(md).replace('\n', '<br>\n')
+
+def _render_in_worker(md, mentions):
+    return mdp.parse_with_mentions(md, mentions)
+
+class RenderPool(object):
+    """
+    Renders markdown in a pool of worker processes so a pathological input
+    can't pin a request thread. Renders over MARKDOWN_RENDER_TIMEOUT seconds
+    or inputs over MARKDOWN_MAX_LENGTH characters fall back to escaped plain
+    text, a timed out pool is killed and started again.
+    
+    Mentions are resolved here and handed to the workers, which never touch
+    the database.
+    """
+    def __init__(self, processes=None, timeout=None, max_length=None):
+        self._processes = processes
+        self._timeout = timeout
+        self._max_length = max_length
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    @property
+    def processes(self):
+        return self._processes or settings.MARKDOWN_RENDER_POOL_SIZE
+    
+    @property
+    def timeout(self):
+        return self._timeout or settings.MARKDOWN_RENDER_TIMEOUT
+    
+    @property
+    def max_length(self):
+        return self._max_length or settings.MARKDOWN_MAX_LENGTH
+    
+    @property
+    def enabled(self):
+        return self.processes > 0
+    
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawned workers set django up themselves instead of
+                # inheriting the parent's database connections
+                ctx = multiprocessing.get_context('spawn')
+                self._pool = ctx.Pool(self.processes, initializer=django.setup)
+            return self._pool
+    
+    def _reset(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.terminate()
+    
+    def render(self, md):
+        """
+        Return (html, complete), complete is False when the plain text
+        fallback was used.
+        """
+        start = time.time()
+        if len(md) > self.max_length:
+            logger.warning("markdown of %d characters not rendered, limit is %d",
+                           len(md), self.max_length)
+            return render_plain(md), False
+        
+        mentions = dict((name, u is not None) for name, u in resolve_mentions(md).items())
+        pool = self._get_pool()
+        result = pool.apply_async(_render_in_worker, (md, mentions))
+        try:
+            rendered = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self._reset(pool)
+            logger.warning("markdown of %d characters timed out after %.1fms",
+                           len(md), (time.time() - start) * 1000)
+            return render_plain(md), False
+        
+        logger.debug("markdown of %d characters rendered in %.1fms",
+                     len(md), (time.time() - start) * 1000)
+        
+        return rendered, True
+
 renderer = NiuRenderer(linenos=False, inlinestyles=False)
-mdp = mistune.Markdown(escape=True, renderer=renderer)
+mdp = NiuMarkdown(escape=True, renderer=renderer)
+render_cache = RenderCache(mdp)
+render_pool = RenderPool()
 
+@receiver(post_save, sender=User)
+def invalidate_mentions_on_save(sender, instance, created=False, update_fields=None, **kwargs):
+    # logins only touch last_login, that can't change a mention link
+    if update_fields and 'username' not in update_fields:
+        return
+    _mentions.last = None
+    render_cache.invalidate_mentions()
+
+@receiver(post_delete, sender=User)
+def invalidate_mentions_on_delete(sender, instance, **kwargs):
+    _mentions.last = None
+    render_cache.invalidate_mentions()
+
+@timed('markdown')
 def render_markdown(md):
-    rendered = mdp(md)
-#     print(type(rendered), rendered)
-    
-    return rendered
+    return render_cache.render(md)
@@ -1,5 +1,10 @@
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Count
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from forum.storage import hashed_storage
 
 class Section(models.Model):
     name = models.CharField(max_length=32, unique=True, blank=False, null=False)
@@ -17,10 +22,10 @@ class Node(models.Model):
     section = models.ForeignKey(Section, on_delete=models.PROTECT, related_name='nodes')
     name = models.CharField(max_length=32, unique=True, blank=False, null=False)
     description = models.TextField(blank=False, null=False)
-    icon_raw = models.ImageField("Node's icon", upload_to='upload/node/%Y%m%d', blank=True, null=True, default="")
-    icon_l = models.ImageField("large icon", upload_to='node/%Y%m%d', blank=True, null=True, default="")
-    icon_m = models.ImageField("medium icon", upload_to='node/%Y%m%d', blank=True, null=True, default="")
-    icon_s = models.ImageField("small icon", upload_to='node/%Y%m%d', blank=True, null=True, default="")
+    icon_raw = models.ImageField("Node's icon", upload_to='upload/node', storage=hashed_storage, blank=True, null=True, default="")
+    icon_l = models.ImageField("large icon", upload_to='node', storage=hashed_storage, blank=True, null=True, default="")
+    icon_m = models.ImageField("medium icon", upload_to='node', storage=hashed_storage, blank=True, null=True, default="")
+    icon_s = models.ImageField("small icon", upload_to='node', storage=hashed_storage, blank=True, null=True, default="")
     order = models.IntegerField(default=0)
     is_trash = models.BooleanField(default=False)
     date_created = models.DateTimeField(auto_now_add=True)
@@ -34,8 +39,9 @@ class Node(models.Model):
         return "%s/%s" % (self.section.name, self.name)
     
     def admin_image(self):
-        if self.icon_s:
-            return '<img src="/media/%s" width="24" height="24" />' % (self.icon_s)
+        icon = self.icon_s or self.icon_raw
+        if icon:
+            return '<img src="/media/%s" width="24" height="24" />' % (icon)
         else:
             return None
     admin_image.allow_tags = True
@@ -53,6 +59,9 @@ class Topic(models.Model):
     liker = models.ManyToManyField(User, blank=True, related_name='like_topics')
     viewed = models.IntegerField(default=0)
     reply_count = models.IntegerField(default=0)
+    like_count = models.IntegerField(default=0)
+    # what activity adds up to, decayed by the decayhotscores command
+    hot_score = models.FloatField(default=0)
     last_replied = models.DateTimeField(blank=True, null=True)
     rank = models.IntegerField(default=10)
     reply_reward = models.BooleanField(default=False)
@@ -63,6 +72,54 @@ class Topic(models.Model):
     
     class Meta():
         ordering = ['-rank', '-date_created']
+        # one per topic list ordering, the id tiebreaker of the list cursors
+        # is part of every index through the rowid or explicitly
+        indexes = [
+            models.Index(fields=['rank', 'date_created'], name='topic_rank_created'),
+            models.Index(fields=['rank', 'last_replied'], name='topic_rank_replied'),
+            models.Index(fields=['rank', 'hot_score'], name='topic_rank_hot'),
+            models.Index(fields=['admin_star', 'rank', 'date_created'], name='topic_star_rank_created'),
+            models.Index(fields=['node', 'rank', 'date_created'], name='topic_node_rank_created'),
+            models.Index(fields=['node', 'rank', '-date_created', '-id'], name='topic_node_latest'),
+            models.Index(fields=['node', 'rank', '-last_replied', '-id'], name='topic_node_replied'),
+            # the default node order is -rank, -hot_score: read backwards
+            models.Index(fields=['node', 'rank', 'hot_score', 'id'], name='topic_node_hot'),
+            models.Index(fields=['author', 'date_created'], name='topic_author_created'),
+        ]
+
+@receiver(m2m_changed, sender=Topic.liker.through)
+def update_like_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep Topic.like_count and hot_score in step with Topic.liker, from either
+    side of the relation. Removals count the rows that actually exist before
+    they go.
+    """
+    likes = sender.objects.all()
+    if reverse:
+        likes = likes.filter(user_id=instance.pk)
+    else:
+        likes = likes.filter(topic_id=instance.pk)
+    
+    if action == 'post_add' and pk_set:
+        if reverse:
+            Topic.objects.filter(id__in=pk_set).update(like_count=F('like_count') + 1,
+                                                       hot_score=F('hot_score') + settings.HOT_SCORE_LIKE)
+        else:
+            n = len(pk_set)
+            Topic.objects.filter(id=instance.pk).update(like_count=F('like_count') + n,
+                                                        hot_score=F('hot_score') + n * settings.HOT_SCORE_LIKE)
+    
+    elif action in ('pre_remove', 'pre_clear'):
+        if action == 'pre_remove':
+            likes = likes.filter(**{'topic_id__in' if reverse else 'user_id__in': pk_set})
+        counts = likes.values_list('topic_id').annotate(n=Count('id'))
+        instance._removed_likes = list(counts)
+    
+    elif action in ('post_remove', 'post_clear'):
+        for topic_id, n in getattr(instance, '_removed_likes', []):
+            Topic.objects.filter(id=topic_id).update(like_count=F('like_count') - n,
+                                                     hot_score=F('hot_score') - n * settings.HOT_SCORE_LIKE)
+        instance._removed_likes = []
 
 class Reply(models.Model):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='replies')
@@ -73,4 +130,25 @@ class Reply(models.Model):
     
     class Meta():
         ordering = ['date_created']
+        indexes = [
+            models.Index(fields=['topic', 'date_created'], name='reply_topic_created'),
+            models.Index(fields=['author', 'date_created'], name='reply_author_created'),
+        ]
+
 
+class Job(models.Model):
+    name = models.CharField(max_length=128, blank=False, null=False)
+    kwargs = models.TextField(default='{}')
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(db_index=True)
+    locked_by = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    failed = models.BooleanField(default=False)
+    error = models.TextField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    
+    class Meta():
+        ordering = ['run_after', 'id']
+    
+    def __str__(self):
+        return "%s(%s)" % (self.name, self.kwargs)
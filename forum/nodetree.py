@@ -0,0 +1,104 @@
+import time
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from forum.models import Section, Node
+
+KEY_PREFIX = 'forum:nodetree'
+
+class NodeTree(object):
+    """
+    The section/node navigation shown beside the topic lists.
+    
+    The tree is built with a single query and kept in process memory and in
+    the NODE_TREE_CACHE cache under a version number. Saving or deleting a
+    Section or Node bumps the version, every process rebuilds on its next read.
+    
+    NODE_TREE_CACHE must name a cache shared by every process, a process
+    local one would hide changes made elsewhere. Unset, the tree is built for
+    every page.
+    """
+    def __init__(self, cache_alias=None):
+        self._cache_alias = cache_alias
+        self._local = (None, None)
+        self._lock = threading.Lock()
+    
+    @property
+    def cache(self):
+        alias = self._cache_alias or settings.NODE_TREE_CACHE
+        if alias:
+            return caches[alias]
+        return None
+    
+    def _key(self, *parts):
+        return ':'.join([KEY_PREFIX] + [str(p) for p in parts])
+    
+    def version(self):
+        key = self._key('version')
+        version = self.cache.get(key)
+        if version is None:
+            # start from the clock, not 1, so an evicted version can't bring
+            # back a tree cached under an earlier one
+            self.cache.add(key, int(time.time() * 1000), None)
+            version = self.cache.get(key, 0)
+        
+        return version
+    
+    def invalidate(self):
+        if self.cache is None:
+            return
+        
+        key = self._key('version')
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, int(time.time() * 1000), None)
+        
+        with self._lock:
+            self._local = (None, None)
+    
+    def build(self):
+        nodes = Node.objects.filter(section__order__gt=0).select_related('section') \
+                            .order_by('-section__order', 'section_id', '-order')
+        sections = []
+        for n in nodes:
+            if not sections or sections[-1]['id'] != n.section_id:
+                sections.append({'id': n.section_id, 'name': n.section.name, 'nodes': []})
+            sections[-1]['nodes'].append({'id': n.id, 'name': n.name})
+        
+        return sections
+    
+    def get(self):
+        """
+        Return a list of {'id', 'name', 'nodes'} for every listed section with
+        at least one node, nodes are {'id', 'name'}.
+        """
+        if self.cache is None:
+            return self.build()
+        
+        version = self.version()
+        local_version, sections = self._local
+        if local_version == version:
+            return sections
+        
+        key = self._key('tree', version)
+        sections = self.cache.get(key)
+        if sections is None:
+            sections = self.build()
+            self.cache.set(key, sections, settings.NODE_TREE_CACHE_TIMEOUT)
+        
+        with self._lock:
+            self._local = (version, sections)
+        
+        return sections
+
+node_tree = NodeTree()
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+def invalidate_node_tree(sender, **kwargs):
+    node_tree.invalidate()
@@ -0,0 +1,136 @@
+import time
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from forum.models import Section, Node, Topic, Reply
+
+KEY_PREFIX = 'forum:page'
+LOCK_TIMEOUT = 10
+WAIT_STEP = 0.05
+
+def _key(*parts):
+    return ':'.join([KEY_PREFIX] + [str(p) for p in parts])
+
+def _page_cache():
+    return caches[settings.PAGE_CACHE]
+
+def tag_versions(cache, tags):
+    keys = [_key('tag', t) for t in tags]
+    versions = cache.get_many(keys)
+    for k in keys:
+        if k not in versions:
+            # start from the clock so an evicted tag can't match old pages
+            cache.add(k, int(time.time() * 1000), None)
+            versions[k] = cache.get(k, 0)
+    
+    return tuple(versions[k] for k in keys)
+
+def invalidate_tags(*tags):
+    """
+    Expire every cached page carrying any of the tags.
+    """
+    if not settings.PAGE_CACHE:
+        return
+    
+    cache = _page_cache()
+    for t in tags:
+        try:
+            cache.incr(_key('tag', t))
+        except ValueError:
+            # not set yet, no page was cached under it
+            pass
+
+class PageCacheMixin(object):
+    """
+    Caches the GET response of a TemplateView for anonymous visitors.
+    
+    A page is stored under its full path together with the versions of the
+    tags from page_cache_tags(), invalidate_tags() bumps a version and the
+    page is rendered again on its next hit. While one request renders an
+    expired page the others are served the stale copy, or wait for the new
+    one when there is none, so a hot page is rendered once, not once per
+    visitor.
+    
+    Disabled unless PAGE_CACHE names a cache shared by every process.
+    """
+    def page_cache_tags(self):
+        return ['site']
+    
+    def page_cache_hit(self):
+        pass
+    
+    def get(self, request, *args, **kwargs):
+        if not settings.PAGE_CACHE or request.user.is_authenticated():
+            return super(PageCacheMixin, self).get(request, *args, **kwargs)
+        
+        cache = _page_cache()
+        path = hashlib.sha1(request.get_full_path().encode('utf-8')).hexdigest()
+        page_key, lock_key = _key('url', path), _key('lock', path)
+        versions = tag_versions(cache, self.page_cache_tags())
+        
+        entry = cache.get(page_key)
+        if entry and entry[0] == versions:
+            return self._cached_response(entry)
+        
+        if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+            if entry:
+                return self._cached_response(entry)
+            
+            # someone else is rendering the first copy, wait for it
+            deadline = time.time() + settings.PAGE_CACHE_WAIT
+            while time.time() < deadline:
+                time.sleep(WAIT_STEP)
+                entry = cache.get(page_key)
+                if entry and entry[0] == versions:
+                    return self._cached_response(entry)
+            
+            return super(PageCacheMixin, self).get(request, *args, **kwargs)
+        
+        try:
+            response = super(PageCacheMixin, self).get(request, *args, **kwargs)
+            response.render()
+            if response.status_code == 200 and not response.cookies:
+                cache.set(page_key, (versions, response.content, response['Content-Type']),
+                          settings.PAGE_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        
+        return response
+    
+    def _cached_response(self, entry):
+        self.page_cache_hit()
+        _versions, content, content_type = entry
+        return HttpResponse(content, content_type=content_type)
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+def invalidate_site_pages(sender, **kwargs):
+    # every page shows node names
+    invalidate_tags('site')
+
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+def invalidate_topic_pages(sender, instance, **kwargs):
+    invalidate_tags('topic:%s' % instance.id, 'node:%s' % instance.node_id, 'index')
+
+@receiver(post_save, sender=Reply)
+@receiver(post_delete, sender=Reply)
+def invalidate_reply_pages(sender, instance, **kwargs):
+    invalidate_tags('topic:%s' % instance.topic_id, 'node:%s' % instance.topic.node_id, 'index')
+
+@receiver(m2m_changed, sender=Topic.liker.through)
+def invalidate_liked_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear') or not settings.PAGE_CACHE:
+        return
+    
+    topic_ids = pk_set if reverse and pk_set else [instance.pk]
+    if reverse and action == 'post_clear':
+        # the cleared topics are gone from the relation, the lists expire on time
+        topic_ids = []
+    for topic_id, node_id in Topic.objects.filter(id__in=topic_ids).values_list('id', 'node_id'):
+        invalidate_tags('topic:%s' % topic_id, 'node:%s' % node_id, 'index')
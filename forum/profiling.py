@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import heapq
+import itertools
+import random
+import logging
+import cProfile
+import threading
+from functools import wraps
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends import django as django_backend
+from django.utils.deprecation import MiddlewareMixin
+
+logger = logging.getLogger('django.request')
+
+_current = threading.local()
+
+class Timings(object):
+    """
+    Time spent by one request in each instrumented part, in seconds.
+
+    A part entered again while it runs, like a template rendered from a
+    template tag, is counted once.
+    """
+    def __init__(self):
+        self.spent = {}
+        self.calls = {}
+        self._depth = {}
+
+    def start(self, name):
+        depth = self._depth.get(name, 0)
+        self._depth[name] = depth + 1
+        return time.perf_counter() if depth == 0 else None
+
+    def stop(self, name, started):
+        self._depth[name] -= 1
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if started is not None:
+            self.spent[name] = self.spent.get(name, 0.0) + time.perf_counter() - started
+
+def timed(name):
+    """
+    Adds the time of the decorated function to the running request's `name`
+    timing, costs a thread local lookup when profiling is off.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = getattr(_current, 'timings', None)
+            if timings is None:
+                return func(*args, **kwargs)
+
+            started = timings.start(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.stop(name, started)
+
+        return wrapper
+
+    return decorator
+
+def _instrument_templates():
+    template = django_backend.Template
+    if not getattr(template.render, 'profiled', False):
+        template.render = timed('template')(template.render)
+        template.render.profiled = True
+
+class SlowestProfiles(object):
+    """
+    Keeps the cProfile dumps of the slowest `keep` requests of this process
+    in `directory`, a slower request pushes out the fastest dump.
+    """
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._heap = []
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def offer(self, duration, request, profile):
+        with self._lock:
+            if len(self._heap) >= self.keep and duration <= self._heap[0][0]:
+                return None
+
+            path = os.path.join(self.directory, 'profile-%d-%d-%dms-%s.prof' % (
+                os.getpid(), next(self._seq), duration * 1000,
+                request.path.strip('/').replace('/', '_') or 'index'))
+            profile.dump_stats(path)
+            if len(self._heap) >= self.keep:
+                _duration, evicted = heapq.heapreplace(self._heap, (duration, path))
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+            else:
+                heapq.heappush(self._heap, (duration, path))
+
+            return path
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Times SQL, template rendering, markdown rendering and thumbnails for
+    every request, sends them as Server-Timing headers and logs them as a
+    JSON line to django.request.
+
+    PROFILING_SAMPLE_RATE of the requests also run under cProfile, the
+    slowest PROFILING_KEEP of those are dumped to PROFILING_DIR.
+
+    Disabled unless PROFILING is set, keep it first in MIDDLEWARE_CLASSES
+    so the total covers the other middleware.
+    """
+    def __init__(self, get_response=None):
+        if not settings.PROFILING:
+            raise MiddlewareNotUsed()
+
+        super(ProfilingMiddleware, self).__init__(get_response)
+        _instrument_templates()
+        self.profiles = SlowestProfiles(settings.PROFILING_DIR, settings.PROFILING_KEEP)
+
+    def process_request(self, request):
+        request._profiling = {
+            'start': time.perf_counter(),
+            'queries': dict((c.alias, len(c.queries_log)) for c in connections.all()),
+            'debug_cursor': dict((c.alias, c.force_debug_cursor) for c in connections.all()),
+            'profile': None,
+        }
+        # the debug cursor logs the time of every query
+        for c in connections.all():
+            c.force_debug_cursor = True
+        _current.timings = Timings()
+
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is running in this process
+                return
+            request._profiling['profile'] = profile
+
+    def process_response(self, request, response):
+        state = getattr(request, '_profiling', None)
+        if state is None:
+            return response
+
+        del request._profiling
+        if state['profile'] is not None:
+            state['profile'].disable()
+        total = time.perf_counter() - state['start']
+        timings = _current.timings
+        _current.timings = None
+
+        query_count = 0
+        sql = 0.0
+        for c in connections.all():
+            if c.alias in state['debug_cursor']:
+                c.force_debug_cursor = state['debug_cursor'][c.alias]
+            # the log is emptied when a request starts and holds its first 9000 queries
+            executed = list(c.queries_log)[state['queries'].get(c.alias, 0):]
+            query_count += len(executed)
+            sql += sum(float(q['time']) for q in executed)
+
+        parts = [('sql', sql, '%d queries' % query_count)]
+        for name in ('template', 'markdown', 'thumbnail'):
+            if name in timings.spent:
+                parts.append((name, timings.spent[name], '%d calls' % timings.calls[name]))
+        parts.append(('total', total, None))
+
+        response['Server-Timing'] = ', '.join(
+            '%s;dur=%.1f' % (name, spent * 1000) + (';desc="%s"' % desc if desc else '')
+            for name, spent, desc in parts)
+
+        line = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': query_count,
+        }
+        line.update(('%s_ms' % name, round(spent * 1000, 3)) for name, spent, _desc in parts)
+        if state['profile'] is not None:
+            line['profile'] = self.profiles.offer(total, request, state['profile'])
+        logger.info('profile %s', json.dumps(line, sort_keys=True),
+                    extra={'status_code': response.status_code, 'request': request})
+
+        return response
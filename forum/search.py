@@ -0,0 +1,191 @@
+import re
+import json
+import base64
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+from django.utils.html import escape
+from forum.models import Topic, Reply
+from forum.utils import topic_list_queryset
+
+TABLE = 'forum_search'
+
+# CJK has no spaces between words, every character is indexed as a token and
+# a query for a word becomes a phrase of its characters
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+CJK_REGEX = re.compile('([%s])' % CJK)
+# segment() pads each character with a space, the highlight marks may sit
+# between a character and its padding
+PADDED_REGEX = re.compile(' ?([\x02\x03]*[%s][\x02\x03]*) ?' % CJK)
+
+def available():
+    return connection.vendor == 'sqlite'
+
+def segment(text):
+    return CJK_REGEX.sub(r' \1 ', text or '')
+
+def _unsegment(text):
+    return PADDED_REGEX.sub(r'\1', text)
+
+def _highlight(text):
+    # the marks are placed by sqlite around raw markdown, escape around them
+    text = escape(_unsegment(text).replace('\x03\x02', ''))
+    return text.replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+def build_query(q):
+    """
+    Turn what the user typed into an FTS5 query matching all of its words, so
+    FTS5 operators and quotes in the input are taken literally.
+    """
+    phrases = []
+    for word in q.split():
+        tokens = segment(word).split()
+        if tokens:
+            phrases.append('"%s"' % ' '.join(tokens).replace('"', '""'))
+    
+    return ' '.join(phrases)
+
+def _rowid(obj):
+    # topics and replies share the table, the low bit tells them apart
+    if isinstance(obj, Topic):
+        return obj.id * 2
+    return obj.id * 2 + 1
+
+def create_index():
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                       "title, body, topic_id UNINDEXED, tokenize='unicode61')" % TABLE)
+
+def _topic_row(topic):
+    return (_rowid(topic), segment(topic.title), segment(topic.markdown), topic.id)
+
+def _reply_row(reply):
+    return (_rowid(reply), '', segment(reply.markdown), reply.topic_id)
+
+def index(obj):
+    row = _topic_row(obj) if isinstance(obj, Topic) else _reply_row(obj)
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE rowid = %%s" % TABLE, [row[0]])
+        cursor.execute("INSERT INTO %s (rowid, title, body, topic_id) VALUES (%%s, %%s, %%s, %%s)" % TABLE, row)
+
+def unindex(obj):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE rowid = %%s" % TABLE, [_rowid(obj)])
+
+def rebuild(chunk_size=1000):
+    """
+    Index every topic and reply again from scratch, return the number of rows
+    indexed.
+    """
+    count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s" % TABLE)
+        insert = "INSERT INTO %s (rowid, title, body, topic_id) VALUES (%%s, %%s, %%s, %%s)" % TABLE
+        sources = ((Topic.objects.only('id', 'title', 'markdown'), _topic_row),
+                   (Reply.objects.only('id', 'topic_id', 'markdown'), _reply_row))
+        for qs, row in sources:
+            rows = []
+            for obj in qs.order_by('id').iterator():
+                rows.append(row(obj))
+                if len(rows) >= chunk_size:
+                    cursor.executemany(insert, rows)
+                    count += len(rows)
+                    rows = []
+            if rows:
+                cursor.executemany(insert, rows)
+                count += len(rows)
+        cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (TABLE, TABLE))
+    
+    return count
+
+def _encode_cursor(rank, rowid):
+    return base64.urlsafe_b64encode(json.dumps([rank, rowid]).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+    try:
+        rank, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return float(rank), int(rowid)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+class SearchResults(object):
+    def __init__(self, hits, next_cursor):
+        self.hits = hits
+        self.next_cursor = next_cursor
+    
+    def __iter__(self):
+        return iter(self.hits)
+    
+    def __len__(self):
+        return len(self.hits)
+    
+    def has_next(self):
+        return self.next_cursor is not None
+
+def search(q, cursor=None, num_per_page=20):
+    """
+    Return a page of topics and replies matching q, best first. Each hit is a
+    dict with the topic, the reply id (None for the topic itself) and
+    highlighted title and snippet HTML.
+    """
+    match = build_query(q)
+    if not match:
+        return SearchResults([], None)
+    
+    sql = ["SELECT s.rowid, s.rank, s.topic_id,"
+           " highlight(%s, 0, char(2), char(3))," % TABLE,
+           " snippet(%s, 1, char(2), char(3), '...', %d)" % (TABLE, settings.SEARCH_SNIPPET_TOKENS),
+           " FROM %s s INNER JOIN forum_topic t ON t.id = s.topic_id" % TABLE,
+           " WHERE %s MATCH %%s AND s.rank MATCH %%s AND t.deleted = 0" % TABLE]
+    params = [match, 'bm25(%s, 1.0)' % settings.SEARCH_TITLE_WEIGHT]
+    
+    after = _decode_cursor(cursor) if cursor else None
+    if after:
+        sql.append(" AND (s.rank > %s OR (s.rank = %s AND s.rowid > %s))")
+        params += [after[0], after[0], after[1]]
+    sql.append(" ORDER BY s.rank, s.rowid LIMIT %s")
+    params.append(num_per_page + 1)
+    
+    with connection.cursor() as c:
+        c.execute(''.join(sql), params)
+        rows = c.fetchall()
+    
+    more = len(rows) > num_per_page
+    rows = rows[:num_per_page]
+    topics = topic_list_queryset(Topic.objects.all()).in_bulk(set(r[2] for r in rows))
+    
+    hits = []
+    for rowid, rank, topic_id, title, snippet in rows:
+        hits.append({'topic': topics[topic_id],
+                     'reply_id': rowid // 2 if rowid % 2 else None,
+                     'title': _highlight(title) if title else escape(topics[topic_id].title),
+                     'snippet': _highlight(snippet)})
+    
+    next_cursor = _encode_cursor(rows[-1][1], rows[-1][0]) if more else None
+    
+    return SearchResults(hits, next_cursor)
+
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    if sender.name == 'forum' and available():
+        create_index()
+
+@receiver(post_save, sender=Topic)
+def index_topic(sender, instance, update_fields=None, **kwargs):
+    # counter updates don't touch the indexed text
+    if update_fields and not set(update_fields) & set(['title', 'markdown']):
+        return
+    if available():
+        index(instance)
+
+@receiver(post_save, sender=Reply)
+def index_reply(sender, instance, **kwargs):
+    if available():
+        index(instance)
+
+@receiver(post_delete, sender=Topic)
+@receiver(post_delete, sender=Reply)
+def unindex_post(sender, instance, **kwargs):
+    if available():
+        unindex(instance)
@@ -0,0 +1,46 @@
+import os
+import re
+import hashlib
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from django.views.static import serve
+
+HASHED_NAME_REGEX = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{40}\.\w+$')
+
+@deconstructible
+class HashedFileSystemStorage(FileSystemStorage):
+    """
+    Stores every file under the sha1 of its content, in the directory
+    upload_to asked for: identical uploads share one file, and the file
+    behind a name never changes, so its URL can be cached forever.
+    """
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        digest = hashlib.sha1()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+
+        ext = os.path.splitext(name)[1].lower()
+        name = os.path.join(os.path.dirname(name), digest[:2], digest + ext)
+        if self.exists(name):
+            return name
+
+        return super(HashedFileSystemStorage, self).save(name, content, max_length)
+
+hashed_storage = HashedFileSystemStorage()
+
+def serve_media(request, path, document_root=None, show_indexes=False):
+    # what MEDIA_URL serves when DEBUG is on, the front end server should
+    # send the same header for hashed names
+    response = serve(request, path, document_root, show_indexes)
+    if response.status_code == 200 and HASHED_NAME_REGEX.search(path):
+        response['Cache-Control'] = 'public, max-age=%d, immutable' % settings.HASHED_MEDIA_MAX_AGE
+
+    return response
@@ -1,3 +1,1040 @@
-from django.test import TestCase
+import os
+import json
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+from unittest import mock
+from io import StringIO, BytesIO
+from PIL import Image
+from datetime import timedelta
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
+from niuauth.models import UserProfile, Avatar, Notification, ReputationStat
+from niuauth.utils import user_reward
+from niuauth.forms import ProfileForm
+from forum.models import Section, Node, Topic, Reply, Job
+from forum.viewcounter import ViewCounter, CacheViewCounter, view_counter, _flush_at_exit
+from forum.mismd import RenderCache, RenderPool, render_cache, render_markdown, mdp, get_lexer
+from forum.utils import get_metioned_user, create_thumbnail, open_image, IMAGE_LARGE
+from forum.jobs import enqueue, run_jobs, node_icon_thumbnails
+from forum.nodetree import node_tree
+from forum.pagecache import invalidate_tags
+from forum import search
+from forum.storage import HASHED_NAME_REGEX, hashed_storage, serve_media
+from forum.profiling import Timings
+from forum.management.commands.benchviews import percentile
 
-# Create your tests here.
+def run_threads(target, count):
+    def _wrapped():
+        try:
+            target()
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=_wrapped) for _i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def create_topics(node, count):
+    for _i in range(count):
+        avatar = Avatar.objects.create(avatar_m='avatar/a_m.png')
+        user = User.objects.create_user('user%d' % avatar.id)
+        UserProfile.objects.create(user=user, avatar=avatar)
+        Topic.objects.create(node=node, author=user, title='topic', admin_star=True)
+
+def image_upload(fmt, size, mode='RGB'):
+    data = BytesIO()
+    Image.new(mode, size).save(data, fmt)
+    return SimpleUploadedFile('upload.%s' % fmt, data.getvalue(), content_type='image/%s' % fmt)
+
+class ViewCounterTest(TransactionTestCase):
+    def setUp(self):
+        # empty the buffer and restart the flush timer
+        view_counter.flush()
+        user = User.objects.create_user('niu', 'niu@niutool.com', 'niuniuniu')
+        UserProfile.objects.create(user=user)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=user, title='topic')
+
+    def test_concurrent_requests(self):
+        url = reverse('topic_view', kwargs={'topic_id': self.topic.id})
+
+        def _view():
+            client = Client()
+            for _i in range(10):
+                self.assertEqual(client.get(url).status_code, 200)
+
+        run_threads(_view, 8)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).viewed, 0)
+        self.assertEqual(view_counter.pending(self.topic.id), 80)
+
+        self.assertEqual(view_counter.flush(), 80)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).viewed, 80)
+        self.assertEqual(view_counter.pending(self.topic.id), 0)
+
+    def _count_while_flushing(self, counter):
+        done = threading.Event()
+
+        def _count():
+            for _i in range(500):
+                counter.incr(self.topic.id)
+
+        def _flush():
+            while not done.is_set():
+                counter.flush()
+            connection.close()
+
+        flusher = threading.Thread(target=_flush)
+        flusher.start()
+        run_threads(_count, 8)
+        done.set()
+        flusher.join()
+
+        counter.flush()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).viewed, 4000)
+
+    def test_flush_while_counting(self):
+        self._count_while_flushing(ViewCounter())
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000}}})
+    def test_shared_flush_while_counting(self):
+        cache.clear()
+        self._count_while_flushing(CacheViewCounter('default'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_flush_survives_eviction(self):
+        cache.clear()
+
+        class EvictingCounter(CacheViewCounter):
+            def _write(self, counts):
+                written = super(EvictingCounter, self)._write(counts)
+                # the cache drops the key between the write and the decr
+                self.cache.delete(self._key('topic', topic_id))
+                return written
+
+        topic_id = self.topic.id
+        counter = EvictingCounter('default')
+        counter.incr(topic_id, 3)
+        self.assertEqual(counter.flush(), 3)
+        self.assertEqual(Topic.objects.get(id=topic_id).viewed, 3)
+        self.assertEqual(counter.flush(), 0)
+
+    def test_flush_command_needs_shared_cache(self):
+        # the command's own buffer is always empty, it must not pretend to flush
+        with self.assertRaises(CommandError):
+            call_command('flushviewed', stdout=StringIO())
+
+    def test_flush_at_exit(self):
+        view_counter.incr(self.topic.id, 5)
+        _flush_at_exit()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).viewed, 5)
+        self.assertEqual(view_counter.pending(self.topic.id), 0)
+
+class TopicListQueryTest(TestCase):
+    # a list page costs the same number of queries whatever its length
+    INDEX_QUERIES = 3
+    NODE_QUERIES = 3
+
+    def setUp(self):
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+
+    def _assert_budget(self, url, budget):
+        for count in (1, 20, 45):
+            cache.clear()
+            create_topics(self.node, count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(queries), budget, url)
+            Topic.objects.all().delete()
+
+    def test_index(self):
+        for order in ('default', 'star', 'latest', 'reply'):
+            self._assert_budget(reverse('forum_index', kwargs={'filter': order}), self.INDEX_QUERIES)
+
+    def test_node(self):
+        for order in ('default', 'star', 'latest', 'reply'):
+            url = reverse('node_view', kwargs={'node_id': self.node.id, 'filter': order})
+            self._assert_budget(url, self.NODE_QUERIES)
+
+class TopicCursorPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        create_topics(self.node, 45)
+        # ties and NULLs in the ordering columns must not lose or repeat rows
+        Topic.objects.filter(id__lte=10).update(rank=0)
+        Topic.objects.filter(id__gt=30).update(last_replied=timezone.now())
+
+    def _walk(self, url, ordering):
+        expected = list(Topic.objects.order_by(*ordering + ['-id']).values_list('id', flat=True))
+
+        response = self.client.get(url)
+        pages = [response.context['topics']]
+        while pages[-1].has_next():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, {'cursor': pages[-1].next_cursor})
+            self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+            pages.append(response.context['topics'])
+
+        self.assertEqual([t.id for p in pages for t in p], expected)
+        self.assertEqual([p.number for p in pages], [1, 2, 3])
+        self.assertEqual(response.context['page_list'], [1, 2, 3])
+
+        while pages[-1].has_previous():
+            response = self.client.get(url, {'cursor': pages[-1].previous_cursor})
+            self.assertEqual(list(response.context['topics']), list(pages[-2]))
+            pages.pop()
+        self.assertEqual(pages[-1].number, 1)
+
+    def test_index_orderings(self):
+        self._walk(reverse('forum_index', kwargs={'filter': 'default'}), ['-rank', '-date_created'])
+        self._walk(reverse('forum_index', kwargs={'filter': 'reply'}), ['-rank', '-last_replied'])
+
+    def test_node_orderings(self):
+        self._walk(reverse('node_view', kwargs={'node_id': self.node.id, 'filter': 'latest'}),
+                   ['rank', '-date_created'])
+        self._walk(reverse('node_view', kwargs={'node_id': self.node.id, 'filter': 'reply'}),
+                   ['rank', '-last_replied'])
+
+    def test_page_number_and_bad_cursor(self):
+        url = reverse('forum_index')
+        response = self.client.get(url, {'page': 3})
+        self.assertEqual(response.context['topics'].number, 3)
+        self.assertEqual(len(response.context['topics']), 5)
+
+        response = self.client.get(url, {'cursor': 'garbage'})
+        self.assertEqual(response.context['topics'].number, 1)
+
+        # well formed cursors carrying values of the wrong type start over too
+        first = list(self.client.get(url).context['topics'])
+        for values in (['x', 'y'], ['x', 'y', 'z'], [1, [2], 3], [1, 2.5, '2017-01-01'], [1, '2017-01-01', 'y']):
+            data = json.dumps([2, False, values]).encode('utf-8')
+            cursor = base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+            for path in (url, reverse('node_view', kwargs={'node_id': self.node.id, 'filter': 'latest'})):
+                response = self.client.get(path, {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.context['topics'].number, 1)
+            self.assertEqual(list(self.client.get(url, {'cursor': cursor}).context['topics']), first)
+
+class RenderCacheTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+
+    def test_hit_and_miss(self):
+        first = render_markdown('# hello')
+        self.assertEqual(render_markdown('# hello'), first)
+        self.assertEqual(render_cache.stats()['hits'], 1)
+        self.assertEqual(render_cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        lru = RenderCache(mdp, size=2)
+        lru.render('a')
+        lru.render('b')
+        lru.render('a')
+        lru.render('c')
+        self.assertEqual(lru.stats()['size'], 2)
+        lru.render('a')
+        lru.render('b')
+        self.assertEqual(lru.hits, 2)
+        self.assertEqual(lru.misses, 4)
+
+    def test_mention_invalidation(self):
+        self.assertNotIn('href', render_markdown('hi @niu'))
+        User.objects.create_user('niu')
+        self.assertIn('href', render_markdown('hi @niu'))
+
+    def test_mentions_across_processes(self):
+        # two caches stand for two processes, only the first sees the signal
+        first, second = RenderCache(mdp), RenderCache(mdp)
+        self.assertNotIn('href', second.render('hi @niu'))
+        User.objects.create_user('niu')
+        self.assertIn('href', second.render('hi @niu'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       MARKDOWN_RENDER_CACHE='default')
+    def test_shared_mention_generation(self):
+        cache.clear()
+        first, second = RenderCache(mdp), RenderCache(mdp)
+        self.assertNotIn('href', first.render('hi @niu'))
+        self.assertNotIn('href', second.render('hi @niu'))
+        self.assertEqual(second.hits, 1)
+
+        # the process saving the user bumps the shared generation for both
+        User.objects.create_user('niu')
+        self.assertIn('href', second.render('hi @niu'))
+        self.assertIn('href', first.render('hi @niu'))
+
+class MentionQueryTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+        self.sender = User.objects.create_user('sender')
+
+    def test_queries_per_render(self):
+        # one query per render however many users are mentioned
+        for count in (1, 10, 50):
+            names = ['m%dx%d' % (count, i) for i in range(count)]
+            for name in names:
+                User.objects.create_user(name)
+            md = ' '.join('@%s' % name for name in names + names + ['nobody', 'no_body'])
+
+            with self.assertNumQueries(1):
+                rendered = render_markdown(md)
+            self.assertEqual(rendered.count('href'), 2*count)
+
+            with self.assertNumQueries(0):
+                mentioned = get_metioned_user(self.sender, md)
+            self.assertEqual(sorted(u.username for u in mentioned), sorted(names))
+
+class LexerRegistryTest(TestCase):
+    def test_lexers_are_reused(self):
+        self.assertIs(get_lexer('python'), get_lexer('python'))
+        self.assertIsNone(get_lexer('nosuchlang'))
+
+        hits = get_lexer.cache_info().hits
+        rendered = mdp('```nosuchlang\n<b>\n```\n\n```nosuchlang\nx\n```')
+        self.assertIn('<pre class="nosuchlang"><code>&lt;b&gt;', rendered)
+        self.assertEqual(get_lexer.cache_info().hits, hits + 2)
+
+    def test_failing_highlight_falls_back(self):
+        with mock.patch('forum.mismd.highlight', side_effect=RuntimeError('lexer bug')):
+            with self.assertLogs('forum.mismd', 'WARNING'):
+                rendered = mdp('```python\n<b>\n```')
+        self.assertIn('<pre class="python"><code>&lt;b&gt;', rendered)
+
+class RenderPoolTest(TestCase):
+    def setUp(self):
+        User.objects.create_user('niu')
+
+    def test_pool_matches_inline(self):
+        pool = RenderPool(processes=1, timeout=30)
+        try:
+            md = '# hi @niu @nobody\n\n```python\nprint(1)\n```'
+            self.assertEqual(pool.render(md), (mdp(md), True))
+        finally:
+            pool._reset(pool._get_pool())
+
+    def test_fallback(self):
+        # starting a worker alone takes longer than this
+        pool = RenderPool(processes=1, timeout=0.001)
+        self.assertEqual(pool.render('<b>\nx'), ('<p>&lt;b&gt;<br>\nx</p>\n', False))
+        self.assertIsNone(pool._pool)
+
+        pool = RenderPool(processes=1, max_length=3)
+        self.assertEqual(pool.render('# hello'), ('<p># hello</p>\n', False))
+        self.assertIsNone(pool._pool)
+
+    def test_fallback_not_cached(self):
+        cache = RenderCache(mdp, size=2)
+        with override_settings(MARKDOWN_RENDER_POOL_SIZE=1, MARKDOWN_MAX_LENGTH=3):
+            self.assertEqual(cache.render('# hello'), '<p># hello</p>\n')
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.render('# hello'), mdp('# hello'))
+
+class MentionFanOutTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user, reputation=10000)
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=self.node, author=self.user, title='topic')
+        self.client.force_login(self.user)
+
+    def _mention(self, count):
+        names = ['f%dx%d' % (count, i) for i in range(count)]
+        for name in names:
+            UserProfile.objects.create(user=User.objects.create_user(name))
+        return names, ' '.join('@%s' % name for name in names)
+
+    def _assert_fan_out(self, post):
+        # the writes don't grow with the number of mentioned users
+        budgets = []
+        for count in (1, 50):
+            names, md = self._mention(count)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(post(md).status_code, 302)
+                run_jobs()
+            budgets.append(len(queries))
+
+            self.assertEqual(Notification.objects.filter(user__username__in=names).count(), count)
+            self.assertEqual(UserProfile.objects.filter(user__username__in=names,
+                                                        unread_count=1).count(), count)
+        self.assertEqual(budgets[0], budgets[1])
+
+    def test_create_topic(self):
+        url = reverse('create_topic_view')
+        self._assert_fan_out(lambda md: self.client.post(
+            url, {'title': 'topic', 'content': md, 'node': self.node.id}))
+
+    def test_reply(self):
+        url = reverse('reply_topic_view', kwargs={'topic_id': self.topic.id})
+        self._assert_fan_out(lambda md: self.client.post(url, {'content': md}))
+
+def failing_job(message):
+    raise ValueError(message)
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=self.user, title='topic', reply_count=8)
+        self.client.force_login(self.user)
+
+    def test_reply_only_enqueues(self):
+        mentioned = User.objects.create_user('mentioned')
+        UserProfile.objects.create(user=mentioned)
+        url = reverse('reply_topic_view', kwargs={'topic_id': self.topic.id})
+        for _i in range(3):
+            self.client.post(url, {'content': 'hi @mentioned'})
+
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(UserProfile.objects.get(user=self.user).reputation, 0)
+        # three notifications and a reward job for each reply from the tenth on
+        self.assertEqual(Job.objects.count(), 5)
+
+        self.assertEqual(run_jobs(), (5, 0))
+        self.assertEqual(Notification.objects.filter(user=mentioned).count(), 3)
+        self.assertEqual(UserProfile.objects.get(user=self.user).reputation,
+                         settings.REP_GET_SETTING[settings.REP_TOPIC_REPLY])
+        self.assertTrue(Topic.objects.get(id=self.topic.id).reply_reward)
+        self.assertEqual(Job.objects.count(), 0)
+
+    @override_settings(JOB_MAX_ATTEMPTS=2, JOB_RETRY_DELAY=0)
+    def test_retry_and_give_up(self):
+        enqueue(failing_job, message='boom')
+        self.assertEqual(run_jobs(), (0, 1))
+        job = Job.objects.get()
+        self.assertEqual(job.attempts, 1)
+        self.assertFalse(job.failed)
+        self.assertIn('boom', job.error)
+
+        self.assertEqual(run_jobs(), (0, 1))
+        self.assertTrue(Job.objects.get().failed)
+        self.assertEqual(run_jobs(), (0, 0))
+
+    def test_delayed_and_locked_jobs_wait(self):
+        enqueue(failing_job, delay=60, message='later')
+        self.assertEqual(run_jobs(), (0, 0))
+
+        Job.objects.update(run_after=timezone.now(), locked_by='other',
+                           locked_until=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(run_jobs(), (0, 0))
+
+@override_settings(NODE_TREE_CACHE='default')
+class NodeTreeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sections = [Section.objects.create(name='section%d' % i, order=i) for i in range(3)]
+        for s in self.sections:
+            for i in range(3):
+                Node.objects.create(section=s, name='%s-node%d' % (s.name, i), description='node', order=i)
+
+    def test_tree(self):
+        with self.assertNumQueries(1):
+            tree = node_tree.get()
+        self.assertEqual([s['name'] for s in tree], ['section2', 'section1'])
+        self.assertEqual([n['name'] for n in tree[0]['nodes']],
+                         ['section2-node2', 'section2-node1', 'section2-node0'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(node_tree.get(), tree)
+
+    def test_index_and_invalidation(self):
+        url = reverse('forum_index')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT "forum_node"')])
+
+        Node.objects.create(section=self.sections[0], name='new', description='node')
+        self.sections[0].order = 9
+        self.sections[0].save()
+        response = self.client.get(url)
+        self.assertEqual([n['name'] for n in response.context['sections'][0]['nodes']][-1], 'new')
+
+        Node.objects.get(name='new').delete()
+        self.assertNotIn('new', [n['name'] for s in node_tree.get() for n in s['nodes']])
+
+    @override_settings(NODE_TREE_CACHE=None)
+    def test_uncached(self):
+        # without a shared cache a change made by another process, which
+        # sends this one no signal, shows on the next page
+        node_tree.get()
+        Node.objects.filter(name='section2-node2').update(name='renamed')
+        with self.assertNumQueries(1):
+            tree = node_tree.get()
+        self.assertEqual(tree[0]['nodes'][0]['name'], 'renamed')
+
+@override_settings(PAGE_CACHE='default')
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        view_counter.flush()
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user, reputation=100)
+        section = Section.objects.create(name='section', order=1)
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        other = Node.objects.create(section=section, name='other', description='node')
+        self.topic = Topic.objects.create(node=self.node, author=self.user, title='topic')
+        self.other = Topic.objects.create(node=other, author=self.user, title='other')
+        self.urls = {
+            'index': reverse('forum_index'),
+            'node': reverse('node_view', kwargs={'node_id': self.node.id}),
+            'other_node': reverse('node_view', kwargs={'node_id': other.id}),
+            'topic': reverse('topic_view', kwargs={'topic_id': self.topic.id}),
+            'other_topic': reverse('topic_view', kwargs={'topic_id': self.other.id}),
+        }
+
+    def _cached(self):
+        cached = set()
+        for name, url in self.urls.items():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            if not queries:
+                cached.add(name)
+        return cached
+
+    def test_anonymous_pages_are_cached(self):
+        self.assertEqual(self._cached(), set())
+        self.assertEqual(self._cached(), set(self.urls))
+        self.assertEqual(self.client.get(self.urls['topic'], {'page': 2}).status_code, 200)
+
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.urls['index'])
+        self.assertTrue(queries)
+
+    def test_reply_invalidates_its_topic_and_node(self):
+        self._cached()
+        self.client.force_login(self.user)
+        self.client.post(reverse('reply_topic_view', kwargs={'topic_id': self.topic.id}),
+                         {'content': 'reply'})
+        self.client.logout()
+        self.assertEqual(self._cached(), set(['other_node', 'other_topic']))
+
+        response = self.client.get(self.urls['topic'])
+        self.assertIn(b'reply', response.content)
+
+    def test_topic_edit_and_node_change(self):
+        self._cached()
+        Topic.objects.get(id=self.topic.id).save()
+        self.assertEqual(self._cached(), set(['other_node', 'other_topic']))
+        self.node.save()
+        self.assertEqual(self._cached(), set())
+
+    def test_hits_count_views(self):
+        for _i in range(3):
+            self.client.get(self.urls['topic'])
+        self.assertEqual(view_counter.pending(self.topic.id), 3)
+
+    def _topic_key(self, kind):
+        return 'forum:page:%s:%s' % (kind, hashlib.sha1(self.urls['topic'].encode('utf-8')).hexdigest())
+
+    @override_settings(PAGE_CACHE_WAIT=0.1)
+    def test_single_flight(self):
+        self._cached()
+        # another request is rendering: a stale copy is served meanwhile
+        cache.add(self._topic_key('lock'), 1)
+        invalidate_tags('topic:%s' % self.topic.id)
+        Topic.objects.filter(id=self.topic.id).update(title='renamed')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.urls['topic'])
+        self.assertNotIn(b'renamed', response.content)
+
+        # with nothing to serve it waits, then renders without caching
+        cache.clear()
+        cache.add(self._topic_key('lock'), 1)
+        self.assertIn(b'renamed', self.client.get(self.urls['topic']).content)
+        self.assertIsNone(cache.get(self._topic_key('url')))
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+
+    def _topic(self, title, markdown=''):
+        return Topic.objects.create(node=self.node, author=self.user, title=title, markdown=markdown)
+
+    def _ids(self, q):
+        return [(h['topic'].id, h['reply_id']) for h in search.search(q)]
+
+    def test_signals_keep_index_current(self):
+        topic = self._topic('sqlite tips', 'use the fts5 extension')
+        self.assertEqual(self._ids('fts5'), [(topic.id, None)])
+
+        reply = Reply.objects.create(topic=topic, author=self.user, markdown='fts5 is built in')
+        self.assertEqual(sorted(self._ids('built')), [(topic.id, reply.id)])
+
+        topic.markdown = 'nothing to see'
+        topic.save()
+        self.assertEqual(self._ids('fts5'), [(topic.id, reply.id)])
+
+        # counter updates are not reindexed
+        with self.assertNumQueries(1):
+            topic.save(update_fields=['reply_count'])
+
+        reply.delete()
+        Topic.objects.filter(id=topic.id).update(deleted=True)
+        self.assertEqual(self._ids('built'), [])
+        topic.delete()
+        self.assertEqual(search.rebuild(), 0)
+
+    def test_chinese_and_highlight(self):
+        topic = self._topic('数据库优化', '<b>索引</b>让查询变快，用django也可以')
+        self.assertEqual(self._ids('查询'), [(topic.id, None)])
+        self.assertEqual(self._ids('询查'), [])
+
+        hit = search.search('索引 django').hits[0]
+        self.assertEqual(hit['snippet'],
+                         '&lt;b&gt;<mark>索引</mark>&lt;/b&gt;让查询变快，用<mark>django</mark>也可以')
+        self.assertEqual(search.search('数据').hits[0]['title'], '<mark>数据</mark>库优化')
+
+    def test_ranking_and_pagination(self):
+        body = self._topic('other', 'python python')
+        title = self._topic('python')
+        for i in range(5):
+            self._topic('filler %d' % i, 'python and more words %d' % i)
+        # the FTS5 syntax in a query is matched literally
+        self.assertEqual(self._ids('python OR NOT "'), [])
+
+        first = search.search('python', num_per_page=3)
+        self.assertEqual(first.hits[0]['topic'].id, title.id)
+        seen = [h['topic'].id for h in first]
+        page = first
+        while page.has_next():
+            page = search.search('python', page.next_cursor, num_per_page=3)
+            seen += [h['topic'].id for h in page]
+        self.assertEqual(sorted(seen), sorted(Topic.objects.values_list('id', flat=True)))
+        self.assertIn(body.id, seen)
+
+    def test_rebuild_and_view(self):
+        topic = self._topic('rebuilt', 'text')
+        Reply.objects.create(topic=topic, author=self.user, markdown='rebuilt reply')
+        self.assertEqual(search.rebuild(chunk_size=1), 2)
+        self.assertEqual(len(self._ids('rebuilt')), 2)
+
+        response = self.client.get(reverse('search_view'), {'q': 'rebuilt'})
+        self.assertEqual(len(response.context['results']), 2)
+        response = self.client.get(reverse('search_view'), {'q': 'rebuilt', 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 200)
+
+class QueryPlanTest(TestCase):
+    # a paginated list query reads its rows in index order, never sorting them
+    # in a temp b-tree; any other query may scan a table or sort, not both
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section', order=1)
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        create_topics(self.node, 25)
+        topic = Topic.objects.first()
+        for _i in range(12):
+            Reply.objects.create(topic=topic, author=self.user, markdown='reply')
+            Notification.objects.create(user=self.user, detail='detail')
+        self.topic = topic
+        self.client.force_login(self.user)
+
+    def _urls(self):
+        for order in ('default', 'star', 'latest', 'reply'):
+            yield reverse('forum_index', kwargs={'filter': order}), {}
+            yield reverse('node_view', kwargs={'node_id': self.node.id, 'filter': order}), {}
+            yield reverse('forum_index', kwargs={'filter': order}), {'page': 2}
+            yield reverse('node_view', kwargs={'node_id': self.node.id, 'filter': order}), {'page': 2}
+        yield reverse('topic_view', kwargs={'topic_id': self.topic.id}), {'page': 1}
+        yield reverse('user_profile', kwargs={'user_id': self.user.username}), {}
+        yield reverse('user_topic', kwargs={'user_id': self.topic.author.username}), {}
+        yield reverse('notification_view'), {}
+
+    def test_list_queries_use_indexes(self):
+        offenders = []
+        for url, params in self._urls():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url, params).status_code, 200)
+                response = self.client.get(url, params)
+                # follow the cursor too, it adds a range condition
+                topics = response.context['topics'] if 'topics' in response.context else None
+                if getattr(topics, 'next_cursor', None):
+                    self.client.get(url, {'cursor': topics.next_cursor})
+
+            for q in queries:
+                if not q['sql'].startswith('SELECT'):
+                    continue
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + q['sql'])
+                    plan = [row[-1] for row in cursor.fetchall()]
+                scans = [p for p in plan if p.startswith('SCAN') and 'USING' not in p]
+                sorts = [p for p in plan if 'TEMP B-TREE' in p]
+                paginated = ' ORDER BY ' in q['sql'] and ' LIMIT ' in q['sql']
+                if sorts and (scans or paginated):
+                    offenders.append((url, q['sql'], plan))
+
+        self.assertEqual(offenders, [])
+
+class LikeCountTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.author)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=self.author, title='topic')
+        self.users = []
+        for i in range(12):
+            u = User.objects.create_user('liker%d' % i)
+            UserProfile.objects.create(user=u)
+            self.users.append(u)
+
+    def _count(self):
+        return Topic.objects.get(id=self.topic.id).like_count
+
+    def _like(self, user, like=True):
+        self.client.force_login(user)
+        url = reverse('like_topic_view', kwargs={'topic_id': self.topic.id})
+        response = self.client.post(url, {'like': 'false' if like else 'true'})
+        return json.loads(response.content.decode('utf-8'))['ret']
+
+    def test_both_sides_of_the_relation(self):
+        self.topic.liker.add(*self.users[:3])
+        self.topic.liker.add(self.users[0])
+        self.users[3].like_topics.add(self.topic)
+        self.assertEqual(self._count(), 4)
+
+        self.topic.liker.remove(self.users[0], self.users[5])
+        self.users[3].like_topics.remove(self.topic)
+        self.assertEqual(self._count(), 2)
+
+        self.users[1].like_topics.clear()
+        self.assertEqual(self._count(), 1)
+        self.topic.liker.clear()
+        self.assertEqual(self._count(), 0)
+
+    def test_view_and_reward(self):
+        for u in self.users[:11]:
+            data = self._like(u)
+        self.assertEqual(data['count'], 11)
+        self.assertEqual(self._like(self.users[0], like=False)['count'], 10)
+        self._like(self.users[11])
+
+        # the reward is paid once, on the tenth like
+        amount = settings.REP_GET_SETTING[settings.REP_TOPIC_LIKE]
+        self.assertEqual(UserProfile.objects.get(user=self.author).reputation, amount)
+        self.assertTrue(Topic.objects.get(id=self.topic.id).like_reward)
+
+    def test_list_without_aggregate(self):
+        self.topic.liker.add(*self.users[:2])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('forum_index'))
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        self.assertEqual(response.context['topics'][0].like_count, 2)
+
+    def test_reconcile(self):
+        self.topic.liker.add(*self.users[:5])
+        Topic.objects.update(like_count=42)
+        out = StringIO()
+        call_command('reconcilelikes', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '1 topics fixed')
+        self.assertEqual(self._count(), 5)
+
+class AtomicCounterTest(TransactionTestCase):
+    THREADS = 8
+    REPLIES = 5
+
+    def setUp(self):
+        self.author = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.author)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=self.author, title='topic')
+
+    def test_concurrent_replies(self):
+        url = reverse('reply_topic_view', kwargs={'topic_id': self.topic.id})
+
+        def _reply():
+            client = Client()
+            client.force_login(self.author)
+            for _i in range(self.REPLIES):
+                self.assertEqual(client.post(url, {'content': 'reply'}).status_code, 302)
+
+        run_threads(_reply, self.THREADS)
+        total = self.THREADS * self.REPLIES
+        self.assertEqual(Reply.objects.count(), total)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).reply_count, total)
+
+    def test_concurrent_rewards(self):
+        def _reward():
+            user = User.objects.get(id=self.author.id)
+            for _i in range(self.REPLIES):
+                user_reward(user, settings.REP_TOPIC_REPLY)
+
+        run_threads(_reward, self.THREADS)
+        amount = settings.REP_GET_SETTING[settings.REP_TOPIC_REPLY]
+        total = self.THREADS * self.REPLIES * amount
+        self.assertEqual(UserProfile.objects.get(user=self.author).reputation, total)
+        # every ledger entry saw its own total
+        self.assertEqual(sorted(ReputationStat.objects.values_list('total', flat=True)),
+                         list(range(amount, total + amount, amount)))
+
+class ThumbnailTest(TestCase):
+    def test_sizes(self):
+        for fmt, mode in (('jpeg', 'RGB'), ('png', 'RGBA'), ('gif', 'P')):
+            upload = image_upload(fmt, (1200, 800), mode)
+            files = create_thumbnail(upload, 'name', fmt)
+            self.assertEqual([f.name for f in files], ['name_%s.%s' % (s, fmt) for s in 'lms'])
+            sizes = [Image.open(f).size for f in files]
+            self.assertEqual(sizes, [(144, 144), (96, 96), (48, 48)])
+            # the upload is left where the caller can save it again
+            self.assertEqual(upload.tell(), 0)
+
+    def test_large_sources_shrink_before_converting(self):
+        # what keeps the pipeline fast: no full size decode or conversion
+        for fmt, mode in (('jpeg', 'RGB'), ('gif', 'P'), ('png', 'LA'), ('png', '1')):
+            img = open_image(image_upload(fmt, (2000, 1600), mode))
+            self.assertLessEqual(min(img.size), 4 * IMAGE_LARGE, fmt + mode)
+            self.assertIn(img.mode, ('RGB', 'RGBA', 'L'))
+
+    @override_settings(THUMBNAIL_MAX_PIXELS=1000*1000)
+    def test_pixel_limit(self):
+        with self.assertRaises(ValueError):
+            create_thumbnail(image_upload('png', (1200, 1000)), 'name', 'png')
+
+        form = ProfileForm({}, {'avatar': image_upload('png', (1200, 1000))})
+        self.assertFalse(form.is_valid())
+        self.assertIn('avatar', form.errors)
+        form = ProfileForm({}, {'avatar': image_upload('png', (1000, 1000))})
+        self.assertTrue(form.is_valid())
+
+    def test_node_icon_job(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        section = Section.objects.create(name='section')
+        with override_settings(MEDIA_ROOT=media_root):
+            node = Node.objects.create(section=section, name='node', description='node',
+                                       icon_raw=image_upload('png', (600, 400)))
+            enqueue(node_icon_thumbnails, node_id=node.id, icon=node.icon_raw.name)
+            # an icon replaced meanwhile is not thumbnailed
+            enqueue(node_icon_thumbnails, node_id=node.id, icon='upload/node/old.png')
+            self.assertEqual(run_jobs(), (2, 0))
+
+            node = Node.objects.get(id=node.id)
+            self.assertEqual(Image.open(node.icon_m.path).size, (96, 96))
+            self.assertTrue(HASHED_NAME_REGEX.search(node.icon_s.name))
+
+class HashedStorageTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def test_named_by_content(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            first = hashed_storage.save('avatar/a.PNG', ContentFile(b'one'))
+            again = hashed_storage.save('avatar/b.png', ContentFile(b'one'))
+            other = hashed_storage.save('avatar/a.png', ContentFile(b'two'))
+            digest = hashlib.sha1(b'one').hexdigest()
+            self.assertEqual(first, 'avatar/%s/%s.png' % (digest[:2], digest))
+            self.assertEqual(again, first)
+            self.assertNotEqual(other, first)
+
+            request = RequestFactory().get('/')
+            response = serve_media(request, first, self.media_root)
+            self.assertIn('immutable', response['Cache-Control'])
+            default_storage.save('avatar/plain.png', ContentFile(b'one'))
+            response = serve_media(request, 'avatar/plain.png', self.media_root)
+            self.assertFalse(response.has_header('Cache-Control'))
+
+@override_settings(HOT_SCORE_TOPIC=10.0, HOT_SCORE_REPLY=3.0, HOT_SCORE_LIKE=5.0, HOT_SCORE_VIEW=0.5,
+                   HOT_SCORE_DECAY=0.5, HOT_SCORE_MIN=1.0)
+class HotScoreTest(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user, reputation=100)
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        self.client.force_login(self.user)
+
+    def _score(self, topic):
+        return Topic.objects.get(id=topic.id).hot_score
+
+    def _order(self, url):
+        return [t.id for t in self.client.get(url).context['topics']]
+
+    def test_activity(self):
+        url = reverse('create_topic_view')
+        for title in ('old', 'new'):
+            self.client.post(url, {'title': title, 'content': 'content', 'node': self.node.id})
+        old, new = Topic.objects.order_by('id')
+        self.assertEqual(self._score(old), 10.0)
+
+        self.client.post(reverse('reply_topic_view', kwargs={'topic_id': old.id}), {'content': 'reply'})
+        old.liker.add(self.user)
+        view_counter.incr(old.id, 2)
+        view_counter.flush()
+        self.assertEqual(self._score(old), 10.0 + 3.0 + 5.0 + 1.0)
+        old.liker.remove(self.user)
+        self.assertEqual(self._score(old), 14.0)
+
+        # the busier topic comes first, against the order of creation
+        self.assertEqual(self._order(reverse('forum_index')), [old.id, new.id])
+        self.assertEqual(self._order(reverse('node_view', kwargs={'node_id': self.node.id})), [old.id, new.id])
+        self.assertEqual(self._order(reverse('forum_index', kwargs={'filter': 'latest'})), [new.id, old.id])
+
+    def test_node_order_uses_index(self):
+        create_topics(self.node, 25)
+        url = reverse('node_view', kwargs={'node_id': self.node.id})
+        with CaptureQueriesContext(connection) as queries:
+            topics = self.client.get(url).context['topics']
+            self.client.get(url, {'cursor': topics.next_cursor})
+
+        lists = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and '"hot_score" DESC' in q['sql']]
+        self.assertEqual(len(lists), 2)
+        for sql in lists:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            self.assertIn('topic_node_hot', ' '.join(plan))
+            self.assertFalse([p for p in plan if 'TEMP B-TREE' in p], plan)
+
+    def test_decay(self):
+        topics = [Topic.objects.create(node=self.node, author=self.user, title='topic', hot_score=score)
+                  for score in (8.0, 1.5, 0.5, 0.0)]
+        out = StringIO()
+        # chunks of one topic add up to the same
+        call_command('decayhotscores', chunk=1, stdout=out)
+        self.assertEqual(out.getvalue().strip(), "2 topics decayed, 1 zeroed")
+        self.assertEqual([self._score(t) for t in topics], [4.0, 0.75, 0.0, 0.0])
+
+        Topic.objects.filter(id=topics[0].id).update(reply_count=2, last_replied=timezone.now())
+        call_command('decayhotscores', rebuild=True, stdout=out)
+        self.assertAlmostEqual(self._score(topics[0]), 16.0, places=3)
+
+class BenchmarkCommandTest(TestCase):
+    def test_seed_forum(self):
+        out = StringIO()
+        call_command('seedforum', users=6, sections=2, nodes=2, topics=12, replies=3, likes=2,
+                     watchers=2, notifications=3, days=1, batch=5, stdout=out)
+        self.assertEqual(User.objects.count(), 6)
+        self.assertEqual(Node.objects.count(), 4)
+        self.assertEqual(Topic.objects.count(), 12)
+
+        # the counters written with the rows agree with the rows
+        for topic in Topic.objects.all():
+            self.assertEqual(topic.reply_count, topic.replies.count())
+            self.assertEqual(topic.like_count, topic.liker.count())
+        self.assertTrue(Topic.objects.filter(hot_score__gt=0).exists())
+        for profile in UserProfile.objects.all():
+            self.assertEqual(profile.unread_count,
+                             Notification.objects.filter(user_id=profile.user_id, read=False).count())
+
+        # seeding again adds to the forum without name clashes
+        call_command('seedforum', users=2, sections=1, nodes=1, topics=1, no_search=True, stdout=out)
+        self.assertEqual(User.objects.count(), 8)
+
+    def test_bench_views(self):
+        call_command('seedforum', users=4, sections=1, nodes=2, topics=5, replies=2, stdout=StringIO())
+        out = StringIO()
+        call_command('benchviews', requests=3, json='-', stdout=out)
+        report = json.loads(out.getvalue())
+
+        for label in ('forum_index', 'forum_index:filter', 'topic_view:topic_id', 'node_view:node_id',
+                      'search_view', 'render_markdown_view', 'leaderboard:period', 'user_profile:user_id'):
+            self.assertEqual(report[label]['status'], 200, label)
+            self.assertEqual(report[label]['requests'], 3)
+            self.assertLessEqual(report[label]['p50_ms'], report[label]['p99_ms'])
+        self.assertNotIn('reply_topic_view:topic_id', report)
+
+    def test_percentile(self):
+        samples = list(range(1, 21))
+        self.assertEqual([percentile(samples, p) for p in (50, 95, 99, 100)], [10, 19, 20, 20])
+        samples = list(range(100, 0, -1))
+        self.assertEqual([percentile(samples, p) for p in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(percentile([7], 99), 7)
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.user = User.objects.create_user('user', password='password')
+        UserProfile.objects.create(user=self.user)
+        node = Node.objects.create(section=Section.objects.create(name='section'), name='node')
+        self.topic = Topic.objects.create(node=node, author=self.user, title='topic')
+
+    def _settings(self, **kwargs):
+        middleware = ['forum.profiling.ProfilingMiddleware'] + settings.MIDDLEWARE_CLASSES[1:]
+        return self.settings(PROFILING=True, PROFILING_DIR=self.profile_dir, MIDDLEWARE_CLASSES=middleware,
+                             **kwargs)
+
+    def test_disabled(self):
+        response = self.client.get(reverse('topic_view', kwargs={'topic_id': self.topic.id}))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_timings(self):
+        with self._settings():
+            client = Client()
+            client.force_login(self.user)
+            with self.assertLogs('django.request', 'INFO') as logs:
+                page = client.get(reverse('topic_view', kwargs={'topic_id': self.topic.id}))
+                rendered = client.post(reverse('render_markdown_view'), {'md': '# title'})
+
+        timing = dict(part.split(';', 1) for part in page['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), set(['sql', 'template', 'total']))
+        self.assertRegex(timing['sql'], r'^dur=[\d.]+;desc="[1-9]\d* queries"$')
+        self.assertIn('markdown', rendered['Server-Timing'])
+
+        line = json.loads(logs.records[0].getMessage().split(' ', 1)[1])
+        self.assertEqual(line['path'], reverse('topic_view', kwargs={'topic_id': self.topic.id}))
+        self.assertEqual(line['status'], 200)
+        self.assertGreater(line['queries'], 0)
+        self.assertLessEqual(line['template_ms'], line['total_ms'])
+        self.assertEqual(logs.records[0].status_code, 200)
+        self.assertNotIn('profile', line)
+
+    def test_nested_calls_counted_once(self):
+        timings = Timings()
+        outer = timings.start('template')
+        inner = timings.start('template')
+        self.assertIsNone(inner)
+        timings.stop('template', inner)
+        self.assertNotIn('template', timings.spent)
+        timings.stop('template', outer)
+        self.assertEqual(timings.calls['template'], 2)
+        self.assertGreater(timings.spent['template'], 0)
+
+    def test_slowest_profiles(self):
+        with self._settings(PROFILING_SAMPLE_RATE=1, PROFILING_KEEP=2):
+            client = Client()
+            with self.assertLogs('django.request', 'INFO') as logs:
+                for _i in range(4):
+                    client.get(reverse('forum_index'))
+
+        dumped = [json.loads(r.getMessage().split(' ', 1)[1]).get('profile') for r in logs.records]
+        self.assertTrue(all(dumped[:2]))
+        # only the two slowest dumps are kept
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+        for name in os.listdir(self.profile_dir):
+            self.assertRegex(name, r'^profile-\d+-\d+-\d+ms-index\.prof$')
@@ -1,21 +1,32 @@
-import re
+import json
+import base64
 from PIL import Image, ImageOps
 from io import BytesIO
-from django.contrib.auth.models import User
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.db.models import F, Q
+from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from django.http import HttpResponseForbidden
 from django.shortcuts import get_object_or_404
 from django.core.files.uploadedfile import SimpleUploadedFile
+from niuauth.models import UserProfile, Notification
 from forum.models import Topic
+from forum.mismd import MENTION_REGEX, mentioned_users
+from forum.profiling import timed
 
-MENTION_REGEX = re.compile(r'@(\w+)', re.M)
 IMAGE_LARGE = 144
 IMAGE_MEDIUM = 96
 IMAGE_SMALL = 48
 NUM_PER_PAGE = 20
 
-def _thumbnail(upload, size, fmt):
-    img = ImageOps.fit(upload, size, Image.ANTIALIAS)
+def _encode(img, fmt):
+    if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    elif fmt == 'gif' and img.mode == 'RGB':
+        # the encoder's own median cut palette costs twenty times as much
+        img = img.quantize(method=Image.FASTOCTREE)
     
     temp = BytesIO()
     img.save(temp, fmt, quality=95)
@@ -23,23 +34,54 @@ def _thumbnail(upload, size, fmt):
     
     return temp
 
-def create_thumbnail(src, new_name, ext):
-    upload = Image.open(BytesIO(src.read()))
-    fmt = src.content_type.split('/')[-1]
+def open_image(src, size=IMAGE_LARGE):
+    """
+    Open an upload for thumbnailing without decoding more than needed: JPEGs
+    are decoded straight at the smallest 1/2, 1/4 or 1/8 scale still twice
+    the size asked for, other images are shrunk to about that before being
+    converted. Images over THUMBNAIL_MAX_PIXELS are refused before any
+    decoding.
+    """
+    src.seek(0)
+    img = Image.open(src)
+    if img.width * img.height > settings.THUMBNAIL_MAX_PIXELS:
+        raise ValueError("image of %dx%d pixels is too large" % img.size)
+    
+    img.draft(img.mode, (size*2, size*2))
+    if img.mode in ('1', 'P', 'LA'):
+        factor = min(img.size) // (size*2)
+        if factor > 1:
+            # palette images resize with nearest neighbour only, shrink them
+            # before the conversion multiplies their memory
+            reduced = (img.width // factor, img.height // factor)
+            img = img.reduce(factor) if img.mode == 'LA' else img.resize(reduced, Image.NEAREST)
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'LA' else 'RGB')
     
-    large = _thumbnail(upload, (IMAGE_LARGE, IMAGE_LARGE), fmt)
-    filename_l = "%s_l.%s" % (new_name, ext)
-    large_file = SimpleUploadedFile(filename_l, large.read(), content_type=src.content_type)
+    return img
+
+@timed('thumbnail')
+def create_thumbnail(src, new_name, ext):
+    # stored files have no content type, the image header is asked instead
+    src.seek(0)
+    fmt = Image.open(src).format.lower()
+    if fmt == 'mpo':
+        # what many phone cameras write, a JPEG with extra frames
+        fmt = 'jpeg'
+    upload = open_image(src)
     
-    medium = _thumbnail(upload, (IMAGE_MEDIUM, IMAGE_MEDIUM), fmt)
-    filename_m = "%s_m.%s" % (new_name, ext)
-    medium_file = SimpleUploadedFile(filename_m, medium.read(), content_type=src.content_type)
+    # fit once from the source, each smaller size is scaled from the one before
+    images = []
+    img = ImageOps.fit(upload, (IMAGE_LARGE, IMAGE_LARGE), Image.LANCZOS)
+    for size, suffix in ((IMAGE_LARGE, 'l'), (IMAGE_MEDIUM, 'm'), (IMAGE_SMALL, 's')):
+        if img.size != (size, size):
+            img = img.resize((size, size), Image.LANCZOS)
+        filename = "%s_%s.%s" % (new_name, suffix, ext)
+        images.append(SimpleUploadedFile(filename, _encode(img, fmt).read(),
+                                         content_type='image/%s' % fmt))
     
-    small = _thumbnail(upload, (IMAGE_SMALL, IMAGE_SMALL), fmt)
-    filename_s = "%s_s.%s" % (new_name, ext)
-    small_file = SimpleUploadedFile(filename_s, small.read(), content_type=src.content_type)
+    src.seek(0)
     
-    return large_file, medium_file, small_file
+    return tuple(images)
 
 def get_pagination(current_page, num_pages, count):
     page_list = []
@@ -56,8 +98,129 @@ def get_pagination(current_page, num_pages, count):
     
     return page_list
 
-def topic_pagination(page, topics):
-    paginator = Paginator(topics, NUM_PER_PAGE)
+def topic_list_queryset(topics):
+    # everything w_topic_list.html touches per row, in the same query
+    return topics.select_related('node', 'author__profile__avatar').defer('markdown', 'content')
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator whose total comes from the cache instead of a COUNT(*) per
+    request, it may lag behind by TOPIC_COUNT_CACHE_TIMEOUT seconds.
+    """
+    def __init__(self, object_list, per_page, count_key, **kwargs):
+        super(EstimatedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_key = 'forum:topic_count:%s' % count_key
+    
+    @cached_property
+    def count(self):
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(self.count_key, count, settings.TOPIC_COUNT_CACHE_TIMEOUT)
+        
+        return count
+    
+    def page(self, number):
+        # never cut the last page short when the estimate is too low
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return Page(self.object_list[bottom:bottom+self.per_page], number, self)
+
+class CursorPage(Page):
+    """
+    A page that also knows the cursors of its neighbours, so the next and
+    previous links seek from an index position instead of an OFFSET.
+    """
+    def __init__(self, object_list, number, paginator, more=None):
+        super(CursorPage, self).__init__(object_list, number, paginator)
+        self.more = more
+        self.next_cursor = ""
+        self.previous_cursor = ""
+    
+    def has_next(self):
+        if self.more is None:
+            return super(CursorPage, self).has_next()
+        return self.more
+    
+    def next_page_number(self):
+        return self.number + 1
+    
+    def previous_page_number(self):
+        return self.number - 1
+
+def _keyset_fields(model, ordering):
+    fields = []
+    for o in ordering:
+        name = o.lstrip('-')
+        fields.append((name, o.startswith('-'), model._meta.get_field(name)))
+    
+    # the primary key makes the order total
+    fields.append(('id', fields[-1][1], model._meta.pk))
+    
+    return fields
+
+def _keyset_filter(fields, values):
+    # rows strictly after values, NULL sorts lowest as it does in SQLite
+    after_q = None
+    equal_q = Q()
+    for (name, desc, field), value in zip(fields, values):
+        if value is None:
+            after = None if desc else Q(**{name + '__isnull': False})
+            equal = Q(**{name + '__isnull': True})
+        else:
+            after = Q(**{'%s__%s' % (name, 'lt' if desc else 'gt'): value})
+            if desc and field.null:
+                after |= Q(**{name + '__isnull': True})
+            equal = Q(**{name: value})
+        
+        if after is not None:
+            after_q = equal_q & after if after_q is None else after_q | (equal_q & after)
+        equal_q &= equal
+    
+    if after_q is None:
+        return Q(pk__in=[])
+    
+    # a plain range on the leading column lets the index narrow the scan
+    name, desc, field = fields[0]
+    if values[0] is not None and not (desc and field.null):
+        after_q &= Q(**{'%s__%s' % (name, 'lte' if desc else 'gte'): values[0]})
+    
+    return after_q
+
+def _encode_cursor(number, backward, fields, obj):
+    values = []
+    for name, _desc, _field in fields:
+        value = getattr(obj, name)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        values.append(value)
+    
+    data = json.dumps([number, backward, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, fields):
+    try:
+        data = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        number, backward, values = json.loads(data.decode('utf-8'))
+        number = max(int(number), 1)
+        if len(values) != len(fields):
+            raise ValueError(cursor)
+        
+        # the cursor comes from the url, every value is checked against its column
+        for i, (_name, _desc, field) in enumerate(fields):
+            if values[i] is not None:
+                values[i] = field.to_python(values[i])
+    except (TypeError, ValueError, UnicodeError, ValidationError):
+        return 1, False, None
+    
+    return number, bool(backward), values
+
+def topic_pagination(page, topics, num_per_page=NUM_PER_PAGE, count_key=None):
+    topics = topic_list_queryset(topics)
+    if count_key:
+        paginator = EstimatedCountPaginator(topics, num_per_page, count_key)
+    else:
+        paginator = Paginator(topics, num_per_page)
     try:
         topic_list = paginator.page(page)
     except PageNotAnInteger:
@@ -69,6 +232,58 @@ def topic_pagination(page, topics):
     
     return topic_list, page_list
 
+def topic_cursor_pagination(page, cursor, topics, ordering, count_key, num_per_page=NUM_PER_PAGE):
+    """
+    Paginate topics by seeking past the (ordering..., id) of the last row
+    shown. Following next/previous never counts or offsets, a numbered link
+    from the page strip falls back to an OFFSET page without a COUNT(*).
+    """
+    fields = _keyset_fields(topics.model, ordering)
+    order_by = ['%s%s' % ('-' if desc else '', name) for name, desc, _field in fields]
+    topics = topic_list_queryset(topics).order_by(*order_by)
+    paginator = EstimatedCountPaginator(topics, num_per_page, count_key)
+    
+    if page and not cursor:
+        try:
+            offset_page = paginator.page(page)
+        except PageNotAnInteger:
+            offset_page = paginator.page(1)
+        except EmptyPage:
+            offset_page = paginator.page(paginator.num_pages)
+        
+        topic_list = CursorPage(list(offset_page.object_list), offset_page.number, paginator)
+    else:
+        number, backward, values = _decode_cursor(cursor or '', fields)
+        if values:
+            if backward:
+                flipped = [(name, not desc, field) for name, desc, field in fields]
+                topics = topics.filter(_keyset_filter(flipped, values)).reverse()
+            else:
+                topics = topics.filter(_keyset_filter(fields, values))
+        
+        rows = list(topics[:num_per_page+1])
+        more = len(rows) > num_per_page
+        rows = rows[:num_per_page]
+        if backward:
+            rows.reverse()
+            if not more:
+                number = 1
+            more = True
+        
+        topic_list = CursorPage(rows, number, paginator, more)
+    
+    if topic_list.object_list:
+        topic_list.next_cursor = _encode_cursor(topic_list.number+1, False, fields, topic_list[-1])
+        topic_list.previous_cursor = _encode_cursor(topic_list.number-1, True, fields, topic_list[0])
+    
+    if topic_list.has_next():
+        num_pages = max(paginator.num_pages, topic_list.number+1)
+    else:
+        num_pages = topic_list.number
+    page_list = get_pagination(topic_list.number, num_pages, 2)
+    
+    return topic_list, page_list
+
 def author_required(view_func):
     def _wrapped_view_func(request, *args, **kwargs):
         topic_id = kwargs.get('topic_id')
@@ -82,9 +297,25 @@ def author_required(view_func):
     return _wrapped_view_func
 
 def get_metioned_user(sender, markdown):
-    mentioned = set(re.findall(MENTION_REGEX, markdown)) - set([sender.username])
-#     mentioned = set(re.findall(MENTION_REGEX, markdown))
+    # reuses the lookup render_markdown just did for the same text
+    names = set(MENTION_REGEX.findall(markdown)) - set([sender.username])
+    mentioned = [u for name, u in mentioned_users(markdown).items()
+                 if u is not None and name in names]
     if mentioned:
-        return User.objects.filter(username__in=mentioned)
+        return mentioned
     
     return None
+
+def notify_users(user_ids, kind, actor_id, topic_id, reply_id=None):
+    """
+    Send the same notification to every user, written with one INSERT and one
+    UPDATE however many users there are. Only ids are stored, the text is
+    rendered when the notification is shown.
+    """
+    if not user_ids:
+        return
+    
+    Notification.objects.bulk_create([
+        Notification(user_id=user_id, kind=kind, actor_id=actor_id, topic_id=topic_id, reply_id=reply_id)
+        for user_id in user_ids])
+    UserProfile.objects.filter(user_id__in=user_ids).update(unread_count=F('unread_count') + 1)
@@ -0,0 +1,221 @@
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from forum.models import Topic
+
+KEY_PREFIX = 'forum:viewed'
+LOCK_TIMEOUT = 30
+GAP_TIMEOUT = 10
+REJOURNAL_EVERY = 100
+
+logger = logging.getLogger(__name__)
+
+class ViewCounter(object):
+    """
+    Write-behind buffer for Topic.viewed.
+
+    Views are accumulated in process memory and written back to the database
+    by the next topic view after VIEW_COUNTER_FLUSH_INTERVAL seconds as
+    batched ``viewed = viewed + n`` updates, one UPDATE per distinct
+    increment. The buffer is also flushed when the process exits, views
+    still buffered when a worker is killed are lost. No other process can
+    see the buffer, the ``flushviewed`` command needs a CacheViewCounter.
+    """
+    def __init__(self, interval=None):
+        self._interval = interval
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    @property
+    def interval(self):
+        return self._interval or settings.VIEW_COUNTER_FLUSH_INTERVAL
+
+    def incr(self, topic_id, n=1):
+        """
+        Count n views of a topic, return the number of views not yet
+        written to the database.
+        """
+        with self._lock:
+            self._counts[topic_id] += n
+            return self._counts[topic_id]
+
+    def pending(self, topic_id):
+        with self._lock:
+            return self._counts.get(topic_id, 0)
+
+    def maybe_flush(self):
+        with self._lock:
+            now = time.time()
+            if now - self._last_flush < self.interval:
+                return 0
+            self._last_flush = now
+
+        return self.flush()
+
+    def flush(self):
+        """
+        Write all pending views to the database, return the number of views
+        written.
+        """
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(int)
+            self._last_flush = time.time()
+
+        try:
+            return self._write(counts)
+        except:
+            # put the views back, the next flush retries them
+            with self._lock:
+                for topic_id, n in counts.items():
+                    self._counts[topic_id] += n
+            raise
+
+    def _write(self, counts):
+        batches = defaultdict(list)
+        for topic_id, n in counts.items():
+            if n > 0:
+                batches[n].append(topic_id)
+        if not batches:
+            return 0
+
+        with transaction.atomic():
+            for n, ids in batches.items():
+                Topic.objects.filter(id__in=ids).update(viewed=F('viewed') + n,
+                                                        hot_score=F('hot_score') + n * settings.HOT_SCORE_VIEW)
+
+        return sum(n * len(ids) for n, ids in batches.items())
+
+class CacheViewCounter(ViewCounter):
+    """
+    Write-behind buffer shared by every process through a django cache
+    (memcached, redis), so any process, or the ``flushviewed`` command, can
+    flush it.
+
+    Topics with pending views are recorded in a journal of sequence numbered
+    keys so a flush never has to scan the topic table. Views whose keys are
+    evicted are lost, size the cache accordingly.
+    """
+    def __init__(self, cache_alias, interval=None):
+        super(CacheViewCounter, self).__init__(interval)
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, *parts):
+        return ':'.join([KEY_PREFIX] + [str(p) for p in parts])
+
+    def _mark_dirty(self, topic_id):
+        cache = self.cache
+        cache.add(self._key('seq'), 0, None)
+        seq = cache.incr(self._key('seq'))
+        cache.set(self._key('dirty', seq), topic_id, None)
+
+    def incr(self, topic_id, n=1):
+        cache = self.cache
+        key = self._key('topic', topic_id)
+
+        if cache.add(key, n, None):
+            pending = n
+        else:
+            try:
+                pending = cache.incr(key, n)
+            except ValueError:
+                # evicted between add and incr
+                return self.incr(topic_id, n)
+
+        # the increment that moves the counter away from zero journals the
+        # topic, journal it again now and then in case the entry was evicted
+        if pending == n or pending % REJOURNAL_EVERY < n:
+            self._mark_dirty(topic_id)
+
+        return pending
+
+    def pending(self, topic_id):
+        return self.cache.get(self._key('topic', topic_id)) or 0
+
+    def maybe_flush(self):
+        # the timer key doubles as a guard, only one caller per interval flushes
+        if self.cache.add(self._key('timer'), 1, self.interval):
+            return self.flush()
+
+        return 0
+
+    def flush(self):
+        cache = self.cache
+        lock = self._key('lock')
+        if not cache.add(lock, 1, LOCK_TIMEOUT):
+            return 0
+
+        try:
+            return self._flush(cache)
+        finally:
+            cache.delete(lock)
+
+    def _flush(self, cache):
+        head = cache.get(self._key('seq')) or 0
+        tail = cache.get(self._key('flushed')) or 0
+        if head < tail:
+            # the sequence was evicted and started over
+            tail = 0
+
+        journal = cache.get_many([self._key('dirty', seq) for seq in range(tail+1, head+1)])
+
+        # stop before a slot that is still being written, unless it has been
+        # missing for so long that it must have been evicted
+        end = head
+        now = time.time()
+        for seq in range(tail+1, head+1):
+            if self._key('dirty', seq) not in journal:
+                gap = cache.get(self._key('gap'))
+                if gap and gap[0] == seq and now - gap[1] > GAP_TIMEOUT:
+                    continue
+                if not gap or gap[0] != seq:
+                    cache.set(self._key('gap'), (seq, now), None)
+                end = seq - 1
+                break
+
+        dirty_keys = [self._key('dirty', seq) for seq in range(tail+1, end+1)]
+        counts = {}
+        for topic_id in set(journal[k] for k in dirty_keys if k in journal):
+            counts[topic_id] = cache.get(self._key('topic', topic_id)) or 0
+
+        flushed = self._write(counts)
+
+        # subtract only what was written, views counted meanwhile stay buffered
+        cache.set(self._key('flushed'), end, None)
+        for topic_id, n in counts.items():
+            if n <= 0:
+                continue
+            try:
+                pending = cache.decr(self._key('topic', topic_id), n)
+            except ValueError:
+                # evicted since it was read, the views written are not counted twice
+                continue
+            if pending > 0:
+                self._mark_dirty(topic_id)
+
+        cache.delete_many(dirty_keys)
+
+        return flushed
+
+def _flush_at_exit():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception("buffered topic views not written at exit")
+
+if settings.VIEW_COUNTER_CACHE:
+    view_counter = CacheViewCounter(settings.VIEW_COUNTER_CACHE)
+else:
+    view_counter = ViewCounter()
+    # a worker that exits cleanly writes what only it holds
+    atexit.register(_flush_at_exit)
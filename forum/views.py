@@ -11,16 +11,20 @@ from django.shortcuts import get_object_or_404
 from django.conf import settings
 from django.utils import timezone
 from django.db import transaction
-from django.template.loader import render_to_string
+from django.db.models import F
 from django.utils.html import strip_tags
 from django.utils.text import Truncator
 from niuauth.utils import user_reward
-from niuauth.models import Notification
-from forum.models import Section, Node, Topic, Reply
+from forum.models import Node, Topic, Reply
 from forum.forms import TopicForm, ReplyForm
-from forum.utils import get_pagination, topic_pagination, get_metioned_user
+from forum.utils import get_pagination, topic_pagination, topic_cursor_pagination, get_metioned_user
 from forum.mismd import render_markdown
 from forum.utils import author_required
+from forum.viewcounter import view_counter
+from forum.nodetree import node_tree
+from forum.pagecache import PageCacheMixin
+from forum.search import search
+from forum.jobs import enqueue, notify_topic, notify_reply, reward_topic_reply
 
 class JsonReturn(object):
     J_SUCCESS = 0
@@ -73,71 +77,76 @@ class AjaxResponseMixin(object):
     def ajax_response(self, json_data):
         return HttpResponse(json.dumps(json_data.get_data()), content_type="application/json")
 
-class ForumIndexView(TemplateView):
+class ForumIndexView(PageCacheMixin, TemplateView):
     template_name = "forum/index.html"
     
+    def page_cache_tags(self):
+        return ['site', 'index']
+    
     def get_context_data(self, **kwargs):
         data = super(ForumIndexView, self).get_context_data(**kwargs)
         
         page = self.request.GET.get('page')
+        cursor = self.request.GET.get('cursor')
         order = self.kwargs.get('filter', 'default')
         
         if order == 'star':
             topics = Topic.objects.filter(admin_star=True).all()
-        elif order == 'latest':
-            topics = Topic.objects.order_by('-rank', '-date_created').all()
-        elif order == 'reply':
-            topics = Topic.objects.order_by('-rank', '-last_replied').all()
+            topic_list, page_list = topic_pagination(page, topics, count_key='index:star')
         else:
-            order = 'default'
-            topics = Topic.objects.all()
+            if order == 'latest':
+                ordering = ['-rank', '-date_created']
+            elif order == 'reply':
+                ordering = ['-rank', '-last_replied']
+            else:
+                order = 'default'
+                ordering = ['-rank', '-hot_score']
+            topic_list, page_list = topic_cursor_pagination(page, cursor, Topic.objects.all(),
+                                                            ordering, 'index')
         
         data['order'] = order
-        topic_list, page_list = topic_pagination(page, topics)
-        
         data['topics'] = topic_list
         data['page_list'] = page_list
         
-        sections = Section.objects.filter(order__gt=0).all()
-        s_list = []
-        for s in sections:
-            if s.nodes.all():
-                tmp = {}
-                tmp['name'] = s.name
-                tmp['nodes'] = s.nodes.all()
-                s_list.append(tmp)
-        data['sections'] = s_list
+        data['sections'] = node_tree.get()
         
         return data
 
 forum_index = ForumIndexView.as_view()
 
-class NodeView(TemplateView):
+class NodeView(PageCacheMixin, TemplateView):
     template_name = "forum/node.html"
     
+    def page_cache_tags(self):
+        return ['site', 'node:%s' % self.kwargs['node_id']]
+    
     def get_context_data(self, **kwargs):
         data = super(NodeView, self).get_context_data(**kwargs)
         
         node_id = self.kwargs['node_id']
         node = get_object_or_404(Node, id=node_id)
         page = self.request.GET.get('page')
+        cursor = self.request.GET.get('cursor')
         order = self.kwargs.get('filter', 'default')
         
         if order == 'star':
             topics = node.topics.filter(admin_star=True).all()
-        elif order == 'latest':
-            topics = node.topics.order_by('rank', '-date_created').all()
-        elif order == 'reply':
-            topics = node.topics.order_by('rank', '-last_replied').all()
+            topic_list, page_list = topic_pagination(page, topics, count_key='node:%s:star' % node.id)
         else:
-            order = 'default'
-            topics = node.topics.all()
+            if order == 'latest':
+                ordering = ['rank', '-date_created']
+            elif order == 'reply':
+                ordering = ['rank', '-last_replied']
+            else:
+                order = 'default'
+                ordering = ['-rank', '-hot_score']
+            topic_list, page_list = topic_cursor_pagination(page, cursor, node.topics.all(),
+                                                            ordering, 'node:%s' % node.id)
         
         watch = False
         if self.request.user.is_authenticated():
             watch = self.request.user.watch_nodes.filter(id=node_id).exists()
         
-        topic_list, page_list = topic_pagination(page, topics)
         data['node'] = node
         data['order'] = order
         data['topics'] = topic_list
@@ -183,7 +192,8 @@ class CreateTopicView(TemplateView):
             else:
                 rank = 10
             topic = Topic(node=node, author=request.user, title=title,
-                          markdown=md, content=rendered, abstract=abstract, rank=rank)
+                          markdown=md, content=rendered, abstract=abstract, rank=rank,
+                          hot_score=settings.HOT_SCORE_TOPIC)
             mentioned = get_metioned_user(request.user, md)
             
             self._commit_changes(topic, mentioned)
@@ -197,16 +207,7 @@ class CreateTopicView(TemplateView):
         topic.save()
         
         if mentioned_user:
-            for u in mentioned_user:
-                data = {}
-                data['topic'] = topic
-                
-                detail = render_to_string("forum/notification/create_topic_notification.html", data)
-                n = Notification(user=u, detail=detail.strip())
-                u.profile.has_notification = True
-                u.profile.save()
-                u.save()
-                n.save()
+            enqueue(notify_topic, topic_id=topic.id, user_ids=[u.id for u in mentioned_user])
 
 create_topic_view = CreateTopicView.as_view()
 
@@ -251,7 +252,9 @@ class UpdateTopicView(TemplateView):
                 topic.rank = 0
             else:
                 topic.rank = 10
-            topic.save()
+            # the counters and hot_score are updated elsewhere
+            topic.save(update_fields=['node', 'title', 'markdown', 'content', 'abstract', 'rank',
+                                      'last_modified'])
             
             return HttpResponseRedirect(reverse('topic_view', kwargs={'topic_id':topic_id}))
         
@@ -259,17 +262,24 @@ class UpdateTopicView(TemplateView):
 
 update_topic_view = UpdateTopicView.as_view()
 
-class TopicView(TemplateView):
+class TopicView(PageCacheMixin, TemplateView):
     template_name = "forum/topic.html"
     
+    def page_cache_tags(self):
+        return ['site', 'topic:%s' % self.kwargs['topic_id']]
+    
+    def page_cache_hit(self):
+        view_counter.incr(int(self.kwargs['topic_id']))
+        view_counter.maybe_flush()
+    
     def get_context_data(self, **kwargs):
         data = super(TopicView, self).get_context_data(**kwargs)
         
         topic_id = self.kwargs['topic_id']
         topic = get_object_or_404(Topic, id=topic_id)
         data['topic'] = topic
-        topic.viewed += 1
-        topic.save()
+        topic.viewed += view_counter.incr(topic.id)
+        view_counter.maybe_flush()
         
         replies = topic.replies.all()
         
@@ -315,28 +325,18 @@ class ReplyTopicView(View):
     
     @transaction.atomic
     def _commit_changes(self, topic, reply, mentioned_user):
-        topic.reply_count += 1
-        if not topic.reply_reward and topic.reply_count >= 10:
-            user_reward(topic.author, settings.REP_TOPIC_REPLY, topic_id=topic.id)
-            topic.reply_reward = True
-            topic.author.profile.save()
-        
-        if mentioned_user:
-            for u in mentioned_user:
-                data = {}
-                data['replier'] = reply.author
-                data['topic'] = topic
-                
-                detail = render_to_string("forum/notification/reply_notification.html", data)
-                n = Notification(user=u, detail=detail.strip())
-                u.profile.has_notification = True
-                u.profile.save()
-                n.save()
+        reply.save()
         
-        topic.last_replied = timezone.now()
+        now = timezone.now()
+        Topic.objects.filter(id=topic.id).update(reply_count=F('reply_count') + 1,
+                                                 hot_score=F('hot_score') + settings.HOT_SCORE_REPLY,
+                                                 last_replied=now, last_modified=now)
+        topic.refresh_from_db(fields=['reply_count', 'reply_reward'])
         
-        reply.save()
-        topic.save()
+        if not topic.reply_reward and topic.reply_count >= 10:
+            enqueue(reward_topic_reply, topic_id=topic.id)
+        if mentioned_user:
+            enqueue(notify_reply, reply_id=reply.id, user_ids=[u.id for u in mentioned_user])
 
 reply_topic_view = ReplyTopicView.as_view()
 
@@ -390,11 +390,12 @@ class LikeTopicView(AjaxResponseMixin, View):
                 topic.liker.add(request.user)
                 ilike = True
                 
-                if not topic.like_reward and topic.liker.count() >= 10:
+                # only the request that flips like_reward pays
+                if Topic.objects.filter(id=topic.id, like_reward=False, like_count__gte=10) \
+                                .update(like_reward=True):
                     user_reward(topic.author, settings.REP_TOPIC_LIKE, topic_id=topic.id)
-                    topic.like_reward = True
-                    topic.author.profile.save()
             
+            topic.refresh_from_db(fields=['like_count'])
         except Topic.DoesNotExist:
             json_data = JsonReturn.error(JsonReturn.J_ERROR,str(_("the topic dose not exist")))
         except:
@@ -403,7 +404,7 @@ class LikeTopicView(AjaxResponseMixin, View):
             json_data = JsonReturn.success("ok")
             json_data.set_value('topicid', topic_id)
             json_data.set_value('ilike', ilike)
-#             json_data.set_value('count', topic.liker.count())
+            json_data.set_value('count', topic.like_count)
         
         return self.ajax_response(json_data)
 
@@ -420,3 +421,19 @@ class RenderMarkdownView(AjaxResponseMixin, View):
         return self.ajax_response(json_data)
 
 render_markdown_view = RenderMarkdownView.as_view()
+
+class SearchView(TemplateView):
+    template_name = "forum/search.html"
+    
+    def get_context_data(self, **kwargs):
+        data = super(SearchView, self).get_context_data(**kwargs)
+        
+        q = self.request.GET.get('q', '').strip()
+        cursor = self.request.GET.get('cursor')
+        
+        data['q'] = q
+        data['results'] = search(q, cursor) if q else None
+        
+        return data
+
+search_view = SearchView.as_view()
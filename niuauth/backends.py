@@ -0,0 +1,26 @@
+from django.contrib.auth import backends
+from django.contrib.auth.models import User
+from allauth.account import auth_backends
+
+class ProfileMixin(object):
+    # every page reads the profile for the navbar, join it to the session user
+    def get_user(self, user_id):
+        try:
+            user = User._default_manager.select_related('profile').get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+
+        return user if self.user_can_authenticate(user) else None
+
+class ModelBackend(ProfileMixin, backends.ModelBackend):
+    pass
+
+class AuthenticationBackend(ProfileMixin, auth_backends.AuthenticationBackend):
+    pass
+
+# sessions store the path of the backend that logged them in, these are the
+# ones used before the profile was joined
+LEGACY_BACKENDS = {
+    'django.contrib.auth.backends.ModelBackend': 'niuauth.backends.ModelBackend',
+    'allauth.account.auth_backends.AuthenticationBackend': 'niuauth.backends.AuthenticationBackend',
+}
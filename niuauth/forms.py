@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 class ProfileForm(forms.Form):
@@ -13,3 +14,10 @@ class ProfileForm(forms.Form):
     location = forms.CharField(required=False, label=_("Location"), max_length=128)
     github = forms.URLField(required=False, label=_('Github'))
     gitlab = forms.URLField(required=False, label=_('Gitlab'))
+    
+    def clean_avatar(self):
+        avatar = self.cleaned_data['avatar']
+        if avatar and avatar.image.width * avatar.image.height > settings.THUMBNAIL_MAX_PIXELS:
+            raise forms.ValidationError(_("The picture is too large"))
+        
+        return avatar
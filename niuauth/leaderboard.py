@@ -0,0 +1,56 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from niuauth.models import UserProfile, ReputationDaily, ReputationWeekly
+from niuauth.utils import week_of
+
+PERIODS = ('all', 'week', 'day')
+KEY_PREFIX = 'niuauth:leaderboard'
+
+def _key(period):
+    today = timezone.localdate()
+    if period == 'day':
+        return '%s:day:%s' % (KEY_PREFIX, today.isoformat())
+    if period == 'week':
+        return '%s:week:%s' % (KEY_PREFIX, week_of(today).isoformat())
+    
+    return '%s:all' % KEY_PREFIX
+
+def compute(period):
+    """
+    Rank the top LEADERBOARD_SIZE users of the period, a list of dicts with
+    username, display_name and amount.
+    """
+    size = settings.LEADERBOARD_SIZE
+    today = timezone.localdate()
+    if period == 'all':
+        rows = UserProfile.objects.filter(reputation__gt=0).order_by('-reputation', 'user_id') \
+                                  .values_list('user__username', 'display_name', 'reputation')
+    else:
+        if period == 'day':
+            rollups = ReputationDaily.objects.filter(day=today)
+        else:
+            rollups = ReputationWeekly.objects.filter(week=week_of(today))
+        rows = rollups.filter(amount__gt=0).order_by('-amount', 'user_id') \
+                      .values_list('user__username', 'user__profile__display_name', 'amount')
+    
+    return [{'username': username, 'display_name': display_name, 'amount': amount}
+            for username, display_name, amount in rows[:size]]
+
+def refresh(period):
+    board = {'ranking': compute(period), 'updated': time.time()}
+    cache.set(_key(period), board, settings.LEADERBOARD_REFRESH)
+    
+    return board
+
+def leaderboard(period='all'):
+    """
+    Return {'ranking', 'updated'} for the period from the cache, ranked again
+    at most every LEADERBOARD_REFRESH seconds.
+    """
+    board = cache.get(_key(period))
+    if board is None:
+        board = refresh(period)
+    
+    return board
@@ -0,0 +1,32 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from niuauth.models import ReputationStat, ReputationDaily, ReputationWeekly
+from niuauth.utils import week_of
+
+class Command(BaseCommand):
+    help = 'rebuild the daily and weekly reputation rollups from the ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000)
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        days = ReputationStat.objects.annotate(day=TruncDate('date')).order_by() \
+                                     .values_list('user_id', 'day').annotate(amount=Sum('amount'))
+        daily = []
+        weekly = defaultdict(int)
+        for user_id, day, amount in days.iterator():
+            daily.append(ReputationDaily(user_id=user_id, day=day, amount=amount))
+            weekly[(user_id, week_of(day))] += amount
+        
+        ReputationDaily.objects.all().delete()
+        ReputationWeekly.objects.all().delete()
+        ReputationDaily.objects.bulk_create(daily, options['batch'])
+        ReputationWeekly.objects.bulk_create(
+            [ReputationWeekly(user_id=user_id, week=week, amount=amount)
+             for (user_id, week), amount in weekly.items()], options['batch'])
+        
+        self.stdout.write("%d daily and %d weekly rollups" % (len(daily), len(weekly)))
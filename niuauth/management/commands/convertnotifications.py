@@ -0,0 +1,65 @@
+import re
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from niuauth.models import Notification
+from forum.models import Topic, Reply
+
+USER_REGEX = re.compile(r'href="[^"]*/user/(\w+)/"')
+TOPIC_REGEX = re.compile(r'href="[^"]*/t/(\d+)/"')
+# the reply number follows the topic link in every language
+SEQ_REGEX = re.compile(r'/t/\d+/">[^<]*</a>[^<]*#(\d+)')
+
+class Command(BaseCommand):
+    help = 'turn notifications stored as rendered html into typed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        converted = kept = 0
+        last = 0
+        while True:
+            rows = list(Notification.objects.filter(kind=Notification.LEGACY, id__gt=last)
+                                            .order_by('id').values_list('id', 'detail')[:options['chunk']])
+            if not rows:
+                break
+            last = rows[-1][0]
+
+            with transaction.atomic():
+                done = self._convert(rows)
+            converted += done
+            kept += len(rows) - done
+
+        self.stdout.write("%d notifications converted, %d left as they were" % (converted, kept))
+
+    def _convert(self, rows):
+        parsed = []
+        for pk, detail in rows:
+            user = USER_REGEX.search(detail or '')
+            topic = TOPIC_REGEX.search(detail or '')
+            if user and topic:
+                seq = SEQ_REGEX.search(detail)
+                parsed.append((pk, user.group(1), int(topic.group(1)), int(seq.group(1)) if seq else None))
+
+        users = dict(User.objects.filter(username__in=set(p[1] for p in parsed)).values_list('username', 'id'))
+        topics = set(Topic.objects.filter(id__in=set(p[2] for p in parsed)).values_list('id', flat=True))
+
+        done = 0
+        for pk, username, topic_id, seq in parsed:
+            if username not in users or topic_id not in topics:
+                continue
+
+            fields = {'kind': Notification.MENTION_TOPIC, 'actor_id': users[username],
+                      'topic_id': topic_id, 'detail': None}
+            if seq:
+                reply_ids = list(Reply.objects.filter(topic_id=topic_id).order_by('id')
+                                              .values_list('id', flat=True)[seq-1:seq])
+                if not reply_ids:
+                    continue
+                fields.update(kind=Notification.MENTION_REPLY, reply_id=reply_ids[0])
+
+            Notification.objects.filter(id=pk).update(**fields)
+            done += 1
+
+        return done
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from niuauth.models import Avatar
+
+FIELDS = ('avatar_raw', 'avatar_l', 'avatar_m', 'avatar_s')
+
+def _referencing(value, lookup=''):
+    q = Q()
+    for field in FIELDS:
+        q |= Q(**{field + lookup: value})
+    return q
+
+class Command(BaseCommand):
+    help = 'delete replaced avatars and the files no other avatar shares'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=500)
+
+    def handle(self, *args, **options):
+        storage = Avatar._meta.get_field('avatar_raw').storage
+        avatars = files = 0
+        while True:
+            # a replaced avatar is flagged deleted before the profile lets go
+            # of it, wait for that
+            rows = list(Avatar.objects.filter(deleted=True, userprofile__isnull=True)
+                                      .values_list('id', *FIELDS)[:options['chunk']])
+            if not rows:
+                break
+
+            names = set(name for row in rows for name in row[1:] if name)
+            live = set()
+            for row in Avatar.objects.filter(_referencing(names, '__in'), deleted=False).values_list(*FIELDS):
+                live.update(row)
+
+            Avatar.objects.filter(id__in=[row[0] for row in rows]).delete()
+            for name in names - live:
+                # an upload of the same picture since the check above takes
+                # the file back
+                if Avatar.objects.filter(_referencing(name), deleted=False).exists():
+                    continue
+                storage.delete(name)
+                files += 1
+            avatars += len(rows)
+
+        self.stdout.write("%d avatars and %d files removed" % (avatars, files))
@@ -0,0 +1,74 @@
+import json
+import time
+from datetime import timedelta
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from niuauth.models import UserProfile, Notification
+
+FIELDS = ('id', 'user_id', 'date', 'kind', 'actor_id', 'topic_id', 'reply_id', 'detail', 'read', 'deleted')
+
+class Command(BaseCommand):
+    help = 'delete cleared notifications and the ones older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='defaults to NOTIFICATION_RETENTION_DAYS')
+        parser.add_argument('--chunk', type=int, default=None,
+                            help='defaults to NOTIFICATION_PURGE_CHUNK')
+        parser.add_argument('--archive', default=None,
+                            help='append the purged notifications to this file as json lines')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='seconds to wait between chunks, so web requests get to write')
+
+    def handle(self, *args, **options):
+        days = options['days'] or settings.NOTIFICATION_RETENTION_DAYS
+        chunk = options['chunk'] or settings.NOTIFICATION_PURGE_CHUNK
+        expired = Notification.objects.filter(Q(deleted=True) | Q(date__lt=timezone.now() - timedelta(days=days)))
+
+        archive = open(options['archive'], 'a') if options['archive'] else None
+        purged = 0
+        last = 0
+        try:
+            while True:
+                # every chunk is its own short transaction, and starts where
+                # the last one stopped instead of scanning the table again
+                with transaction.atomic():
+                    rows = list(expired.filter(id__gt=last).order_by('id').values(*FIELDS)[:chunk])
+                    if not rows:
+                        break
+                    self._delete(rows)
+                last = rows[-1]['id']
+                purged += len(rows)
+
+                # only rows whose delete committed are archived
+                if archive:
+                    for row in rows:
+                        row['date'] = row['date'].isoformat()
+                        archive.write(json.dumps(row) + '\n')
+                    archive.flush()
+                if len(rows) < chunk:
+                    break
+                time.sleep(options['sleep'])
+        finally:
+            if archive:
+                archive.close()
+
+        self.stdout.write("%d notifications purged" % purged)
+
+    def _delete(self, rows):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (
+                connection.ops.quote_name(Notification._meta.db_table), ', '.join(['%s'] * len(rows))),
+                [row['id'] for row in rows])
+
+        # unread ones are taken off the counts, one UPDATE per distinct amount
+        unread = Counter(row['user_id'] for row in rows if not row['read'])
+        batches = defaultdict(list)
+        for user_id, n in unread.items():
+            batches[n].append(user_id)
+        for n, user_ids in batches.items():
+            UserProfile.objects.filter(user_id__in=user_ids).update(unread_count=F('unread_count') - n)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from niuauth.leaderboard import PERIODS, refresh
+
+class Command(BaseCommand):
+    help = 'rank the reputation leaderboards again, run it from cron'
+
+    def handle(self, *args, **options):
+        for period in PERIODS:
+            board = refresh(period)
+            self.stdout.write("%s: %d users ranked" % (period, len(board['ranking'])))
@@ -0,0 +1,15 @@
+from django.contrib.auth import BACKEND_SESSION_KEY
+from django.utils.deprecation import MiddlewareMixin
+from niuauth.backends import LEGACY_BACKENDS
+
+class LegacyBackendMiddleware(MiddlewareMixin):
+    """
+    Moves sessions logged in under a backend path no longer listed in
+    AUTHENTICATION_BACKENDS to its niuauth.backends replacement, so they stay
+    logged in without the old backends checking passwords on every failed
+    login. Must come before AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        path = request.session.get(BACKEND_SESSION_KEY)
+        if path in LEGACY_BACKENDS:
+            request.session[BACKEND_SESSION_KEY] = LEGACY_BACKENDS[path]
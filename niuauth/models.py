@@ -4,13 +4,18 @@ from django.contrib.auth.models import User
 from django.conf import settings
 from allauth.account.models import EmailAddress
 from allauth.account.signals import user_signed_up, user_logged_in
+from forum.storage import hashed_storage
 
 class Avatar(models.Model):
-    avatar_raw = models.ImageField("User upload avatar", upload_to='upload/%Y%m%d', blank=False, null=False, default="")
-    avatar_l = models.ImageField("large avatar", upload_to='avatar/%Y%m%d', blank=False, null=False, default="")
-    avatar_m = models.ImageField("medium avatar", upload_to='avatar/%Y%m%d', blank=False, null=False, default="")
-    avatar_s = models.ImageField("small avatar", upload_to='avatar/%Y%m%d', blank=False, null=False, default="")
+    avatar_raw = models.ImageField("User upload avatar", upload_to='upload', storage=hashed_storage, blank=False, null=False, default="")
+    avatar_l = models.ImageField("large avatar", upload_to='avatar', storage=hashed_storage, blank=False, null=False, default="")
+    avatar_m = models.ImageField("medium avatar", upload_to='avatar', storage=hashed_storage, blank=False, null=False, default="")
+    avatar_s = models.ImageField("small avatar", upload_to='avatar', storage=hashed_storage, blank=False, null=False, default="")
     deleted = models.BooleanField(default=False)
+    
+    def ready(self):
+        # the thumbnails are made after the upload by the runjobs worker
+        return bool(self.avatar_s)
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, primary_key=True, verbose_name='user', related_name='profile')
@@ -26,9 +31,9 @@ class UserProfile(models.Model):
     profile_init_reward = models.BooleanField(default=False)
     last_modified = models.DateTimeField(auto_now=True, blank=True, null=True)
     avatar = models.ForeignKey(Avatar, on_delete=models.PROTECT, blank=True, null=True)
-    reputation = models.IntegerField(default=0)
+    reputation = models.IntegerField(default=0, db_index=True)
     following = models.ManyToManyField('UserProfile', blank=True, related_name='follower')
-    has_notification = models.BooleanField(default=False)
+    unread_count = models.IntegerField(default=0)
     
     def __unicode__(self):
         return "{}'s profile".format(self.user.username)
@@ -57,15 +62,62 @@ class ReputationStat(models.Model):
     topic_id = models.IntegerField(blank=True, null=True)
     node_id = models.IntegerField(blank=True, null=True)
 
+class ReputationDaily(models.Model):
+    user = models.ForeignKey(User, related_name='repu_daily')
+    day = models.DateField()
+    amount = models.IntegerField(default=0)
+    
+    class Meta():
+        unique_together = ('user', 'day')
+        indexes = [
+            models.Index(fields=['day', 'amount'], name='repu_daily_day_amount'),
+        ]
+
+class ReputationWeekly(models.Model):
+    user = models.ForeignKey(User, related_name='repu_weekly')
+    week = models.DateField("monday of the week")
+    amount = models.IntegerField(default=0)
+    
+    class Meta():
+        unique_together = ('user', 'week')
+        indexes = [
+            models.Index(fields=['week', 'amount'], name='repu_weekly_week_amount'),
+        ]
+
 class Notification(models.Model):
+    LEGACY = 0
+    MENTION_TOPIC = 1
+    MENTION_REPLY = 2
+    KIND_CHOICES = (
+        (LEGACY, 'legacy'),
+        (MENTION_TOPIC, 'mentioned in a topic'),
+        (MENTION_REPLY, 'mentioned in a reply'),
+    )
+    TEMPLATES = {
+        MENTION_TOPIC: 'forum/notification/create_topic_notification.html',
+        MENTION_REPLY: 'forum/notification/reply_notification.html',
+    }
+    
     user = models.ForeignKey(User, related_name='notifications')
     date = models.DateTimeField(auto_now=True, blank=False, null=False, db_index=True)
-    detail = models.TextField(blank=False, null=False)
+    # what happened is rendered when the notification is shown, a legacy
+    # notification keeps the html rendered when it was sent
+    kind = models.SmallIntegerField(choices=KIND_CHOICES, default=LEGACY)
+    actor = models.ForeignKey(User, blank=True, null=True, related_name='+')
+    topic = models.ForeignKey('forum.Topic', blank=True, null=True, related_name='+')
+    reply = models.ForeignKey('forum.Reply', blank=True, null=True, related_name='+')
+    detail = models.TextField(blank=True, null=True)
     read = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
     
     class Meta():
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['user', 'deleted', 'date'], name='notification_user_deleted_date'),
+        ]
+    
+    def template_name(self):
+        return self.TEMPLATES.get(self.kind)
 
 @receiver(user_signed_up)
 def set_initial_user_profile(request, user, sociallogin=None, **kwargs):
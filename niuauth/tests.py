@@ -1,3 +1,379 @@
-from django.test import TestCase
+import json
+import shutil
+import datetime
+import tempfile
+from unittest import mock
+from io import StringIO, BytesIO
+from PIL import Image
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.contrib.auth import BACKEND_SESSION_KEY, authenticate
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.db.models.signals import post_delete
+from niuauth.models import Avatar, UserProfile, Notification, ReputationStat, ReputationDaily, ReputationWeekly
+from niuauth.utils import user_reward, week_of, clear_notifications
+from niuauth.leaderboard import leaderboard
+from forum.models import Section, Node, Topic, Reply, Job
+from forum.jobs import run_jobs
+from forum.utils import notify_users
 
-# Create your tests here.
+class UserTopicQueryTest(TestCase):
+    USER_TOPIC_QUERIES = 6
+
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        self.client.force_login(self.user)
+
+    def test_user_topic(self):
+        url = reverse('user_topic', kwargs={'user_id': self.user.username})
+        for count in (1, 10):
+            for _i in range(count):
+                Topic.objects.create(node=self.node, author=self.user, title='topic')
+            with self.assertNumQueries(self.USER_TOPIC_QUERIES):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            Topic.objects.all().delete()
+
+class ReputationRollupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = []
+        for i in range(3):
+            user = User.objects.create_user('user%d' % i)
+            UserProfile.objects.create(user=user)
+            self.users.append(user)
+
+    def _rollups(self):
+        daily = sorted(ReputationDaily.objects.values_list('user__username', 'day', 'amount'))
+        weekly = sorted(ReputationWeekly.objects.values_list('user__username', 'week', 'amount'))
+        return daily, weekly
+
+    def test_reward_and_backfill(self):
+        for user, times in zip(self.users, (3, 1, 2)):
+            for _i in range(times):
+                user_reward(user, settings.REP_TOPIC_REPLY)
+        # an older entry only the backfill knows about
+        ReputationStat.objects.filter(user=self.users[1]).update(
+            date=timezone.now() - datetime.timedelta(days=7))
+
+        amount = settings.REP_GET_SETTING[settings.REP_TOPIC_REPLY]
+        today = timezone.localdate()
+        self.assertIn(('user0', today, 3*amount), self._rollups()[0])
+
+        call_command('backfillreputation', stdout=StringIO())
+        daily, weekly = self._rollups()
+        last_week = today - datetime.timedelta(days=7)
+        self.assertEqual(daily, [('user0', today, 3*amount), ('user1', last_week, amount),
+                                 ('user2', today, 2*amount)])
+        self.assertEqual(weekly, [('user0', week_of(today), 3*amount),
+                                  ('user1', week_of(last_week), amount),
+                                  ('user2', week_of(today), 2*amount)])
+
+    def test_leaderboard(self):
+        for user, times in zip(self.users, (1, 3, 2)):
+            for _i in range(times):
+                user_reward(user, settings.REP_TOPIC_LIKE)
+
+        for period in ('all', 'week', 'day'):
+            ranking = leaderboard(period)['ranking']
+            self.assertEqual([r['username'] for r in ranking], ['user1', 'user2', 'user0'])
+            with self.assertNumQueries(0):
+                leaderboard(period)
+
+        # served from the ranking until it is refreshed
+        for _i in range(3):
+            user_reward(self.users[0], settings.REP_TOPIC_LIKE)
+        self.assertEqual(leaderboard('day')['ranking'][0]['username'], 'user1')
+        call_command('refreshleaderboard', stdout=StringIO())
+        self.assertEqual(leaderboard('day')['ranking'][0]['username'], 'user0')
+
+        response = self.client.get(reverse('leaderboard', kwargs={'period': 'week'}))
+        self.assertContains(response, 'user0')
+        self.assertEqual(self.client.get(reverse('leaderboard', kwargs={'period': 'year'})).status_code, 404)
+
+class AvatarThumbnailTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_thumbnails_in_background(self):
+        data = BytesIO()
+        Image.new('RGB', (600, 400)).save(data, 'png')
+        upload = SimpleUploadedFile('me.png', data.getvalue(), content_type='image/png')
+        with override_settings(MEDIA_ROOT=self.media_root):
+            response = self.client.post(reverse('settings_profile'), {'avatar': upload})
+            self.assertEqual(response.status_code, 302)
+
+            # the upload is stored as is and the default avatar is served
+            avatar = UserProfile.objects.get(user=self.user).avatar
+            self.assertTrue(avatar.avatar_raw)
+            self.assertFalse(avatar.ready())
+            self.assertEqual(Job.objects.count(), 1)
+            response = self.client.get(reverse('settings_profile'))
+            self.assertContains(response, avatar.avatar_raw.url)
+
+            self.assertEqual(run_jobs(), (1, 0))
+            avatar = Avatar.objects.get(id=avatar.id)
+            self.assertTrue(avatar.ready())
+            self.assertEqual(Image.open(avatar.avatar_l.path).size, (144, 144))
+            self.assertEqual(Image.open(avatar.avatar_s.path).size, (48, 48))
+            response = self.client.get(reverse('settings_profile'))
+            self.assertContains(response, avatar.avatar_m.url)
+
+    def test_same_picture_shares_files(self):
+        data = BytesIO()
+        Image.new('RGB', (600, 400)).save(data, 'png')
+        with override_settings(MEDIA_ROOT=self.media_root):
+            for _i in range(2):
+                upload = SimpleUploadedFile('me.png', data.getvalue(), content_type='image/png')
+                self.client.post(reverse('settings_profile'), {'avatar': upload})
+                run_jobs()
+
+            first, second = Avatar.objects.order_by('id')
+            self.assertTrue(first.deleted)
+            self.assertEqual(first.avatar_raw.name, second.avatar_raw.name)
+            self.assertEqual(first.avatar_m.name, second.avatar_m.name)
+
+            # the shared files stay with the live avatar
+            out = StringIO()
+            call_command('gcavatars', stdout=out)
+            self.assertEqual(out.getvalue().strip(), "1 avatars and 0 files removed")
+            self.assertTrue(second.avatar_raw.storage.exists(second.avatar_raw.name))
+
+            data = BytesIO()
+            Image.new('RGB', (300, 300), 'red').save(data, 'png')
+            upload = SimpleUploadedFile('other.png', data.getvalue(), content_type='image/png')
+            self.client.post(reverse('settings_profile'), {'avatar': upload})
+            run_jobs()
+            out = StringIO()
+            call_command('gcavatars', stdout=out)
+            self.assertEqual(out.getvalue().strip(), "1 avatars and 4 files removed")
+            for field in ('avatar_raw', 'avatar_l', 'avatar_m', 'avatar_s'):
+                self.assertFalse(second.avatar_raw.storage.exists(getattr(second, field).name))
+
+    def _upload(self, color):
+        data = BytesIO()
+        Image.new('RGB', (300, 300), color).save(data, 'png')
+        upload = SimpleUploadedFile('me.png', data.getvalue(), content_type='image/png')
+        self.client.post(reverse('settings_profile'), {'avatar': upload})
+
+    def test_replaced_avatar_not_reused(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            self._upload('red')
+            run_jobs()
+            self._upload('blue')
+            run_jobs()
+
+            # the red files belong to a replaced avatar gcavatars may remove
+            self._upload('red')
+            avatar = UserProfile.objects.get(user=self.user).avatar
+            self.assertFalse(avatar.ready())
+            self.assertEqual(run_jobs(), (1, 0))
+
+    def test_gc_keeps_files_taken_back(self):
+        def upload_again(sender, instance, **kwargs):
+            # the same picture uploaded while gcavatars runs
+            Avatar.objects.create(avatar_raw=instance.avatar_raw.name, avatar_l=instance.avatar_l.name,
+                                  avatar_m=instance.avatar_m.name, avatar_s=instance.avatar_s.name)
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            self._upload('red')
+            run_jobs()
+            self._upload('blue')
+            run_jobs()
+            red = Avatar.objects.get(deleted=True)
+
+            post_delete.connect(upload_again, sender=Avatar)
+            try:
+                call_command('gcavatars', stdout=StringIO())
+            finally:
+                post_delete.disconnect(upload_again, sender=Avatar)
+
+            for field in ('avatar_raw', 'avatar_l', 'avatar_m', 'avatar_s'):
+                self.assertTrue(red.avatar_raw.storage.exists(getattr(red, field).name))
+
+class UnreadCountTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=self.user, title='topic')
+        self.client.force_login(self.user)
+
+    def _notify(self, count):
+        for _i in range(count):
+            notify_users([self.user.id], Notification.MENTION_TOPIC, self.user.id, self.topic.id)
+
+    def test_count(self):
+        self._notify(3)
+        self.assertEqual(UserProfile.objects.get(user=self.user).unread_count, 3)
+
+        # the profile comes with the session user, not in a query of its own
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('leaderboard'))
+        self.assertContains(response, '<span class="badge">3</span>')
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT "user_profile"')])
+
+        response = self.client.get(reverse('notification_view'))
+        self.assertContains(response, 'list-group-item-info', count=3)
+        self.assertNotContains(response, 'class="badge"')
+        self.assertEqual(UserProfile.objects.get(user=self.user).unread_count, 0)
+        self.assertFalse(Notification.objects.filter(read=False).exists())
+
+        self._notify(1)
+        self.client.get(reverse('clear_notification_view'))
+        self.assertEqual(UserProfile.objects.get(user=self.user).unread_count, 0)
+
+    def test_session_from_old_backend(self):
+        # sessions from before niuauth.backends keep their user
+        self.client.logout()
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('notification_view'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['user'], self.user)
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'niuauth.backends.ModelBackend')
+
+    def test_failed_login_checks_password_per_backend(self):
+        # the replaced backends are not asked again
+        with mock.patch.object(User, 'check_password', autospec=True, return_value=False) as check:
+            self.assertIsNone(authenticate(username='niu', password='wrong'))
+        self.assertEqual(check.call_count, len(settings.AUTHENTICATION_BACKENDS))
+
+class NotificationRenderTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        self.node = Node.objects.create(section=section, name='node', description='node')
+        self.client.force_login(self.user)
+
+    def _notify(self, count):
+        for i in range(count):
+            actor = User.objects.create_user('actor%d' % Notification.objects.count())
+            topic = Topic.objects.create(node=self.node, author=actor, title='title %d' % i)
+            notify_users([self.user.id], Notification.MENTION_TOPIC, actor.id, topic.id)
+            replies = [Reply.objects.create(topic=topic, author=actor, content='reply') for _j in range(2)]
+            notify_users([self.user.id], Notification.MENTION_REPLY, actor.id, topic.id, replies[1].id)
+
+    def test_batch_render(self):
+        # one query each for the users, topics and replies of a page
+        budgets = []
+        for count in (1, 5):
+            self._notify(count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('notification_view'))
+            budgets.append(len(queries))
+        self.assertEqual(budgets[0], budgets[1])
+
+        self.assertContains(response, 'title 4')
+        self.assertContains(response, '#2', count=5)
+        # titles are read when shown, not when sent
+        Topic.objects.filter(title='title 4').update(title='renamed')
+        self.assertContains(self.client.get(reverse('notification_view')), 'renamed')
+
+    def test_convert(self):
+        actor = User.objects.create_user('actor')
+        topic = Topic.objects.create(node=self.node, author=actor, title='Issue #7')
+        replies = [Reply.objects.create(topic=topic, author=actor, content='reply') for _j in range(3)]
+        topic_url = reverse('topic_view', kwargs={'topic_id': topic.id})
+        user_url = reverse('user_profile', kwargs={'user_id': 'actor'})
+        legacy = [
+            '<a class="niu-link" href="%s">actor</a> mentioned you in <a href="%s">Issue #7</a>' % (user_url, topic_url),
+            '<a class="niu-link" href="%s">actor</a> mentioned you in <a href="%s">Issue #7</a> comment #2' % (user_url, topic_url),
+            'something else',
+        ]
+        for detail in legacy:
+            Notification.objects.create(user=self.user, detail=detail)
+
+        out = StringIO()
+        call_command('convertnotifications', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "2 notifications converted, 1 left as they were")
+        rows = Notification.objects.order_by('id').values_list('kind', 'actor_id', 'topic_id', 'reply_id', 'detail')
+        self.assertEqual(list(rows), [
+            (Notification.MENTION_TOPIC, actor.id, topic.id, None, None),
+            (Notification.MENTION_REPLY, actor.id, topic.id, replies[1].id, None),
+            (Notification.LEGACY, None, None, None, 'something else'),
+        ])
+        self.assertContains(self.client.get(reverse('notification_view')), 'something else')
+
+class NotificationRetentionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('niu')
+        UserProfile.objects.create(user=self.user)
+        section = Section.objects.create(name='section')
+        node = Node.objects.create(section=section, name='node', description='node')
+        self.topic = Topic.objects.create(node=node, author=self.user, title='topic')
+        self.client.force_login(self.user)
+
+    def _notify(self, count):
+        for _i in range(count):
+            notify_users([self.user.id], Notification.MENTION_TOPIC, self.user.id, self.topic.id)
+
+    def test_clear(self):
+        self._notify(3)
+        user = User.objects.select_related('profile').get(id=self.user.id)
+        with CaptureQueriesContext(connection) as queries:
+            clear_notifications(user)
+        # nothing is read back or deleted row by row
+        self.assertEqual([q['sql'].split()[0] for q in queries if 'SAVEPOINT' not in q['sql']],
+                         ['UPDATE', 'UPDATE', 'UPDATE'])
+        self.assertEqual(Notification.objects.filter(deleted=True, read=True).count(), 3)
+        self.assertEqual(UserProfile.objects.get(user=self.user).unread_count, 0)
+        self.assertContains(self.client.get(reverse('notification_view')), 'list-group-item-info', count=0)
+
+    def test_purge(self):
+        self._notify(5)
+        old = timezone.now() - datetime.timedelta(days=settings.NOTIFICATION_RETENTION_DAYS + 1)
+        ids = list(Notification.objects.order_by('id').values_list('id', flat=True))
+        Notification.objects.filter(id__in=ids[:2]).update(date=old)
+        Notification.objects.filter(id=ids[2]).update(deleted=True, read=True)
+
+        archive = tempfile.NamedTemporaryFile(mode='r', suffix='.jsonl')
+        self.addCleanup(archive.close)
+        out = StringIO()
+        call_command('purgenotifications', chunk=2, archive=archive.name, stdout=out)
+        self.assertEqual(out.getvalue().strip(), "3 notifications purged")
+        self.assertEqual(list(Notification.objects.values_list('id', flat=True).order_by('id')), ids[3:])
+        self.assertEqual([json.loads(line)['id'] for line in archive], ids[:3])
+        # the two expired unread ones are no longer counted
+        self.assertEqual(UserProfile.objects.get(user=self.user).unread_count, 3)
+
+    def test_purge_chunks_and_archive(self):
+        self._notify(5)
+        Notification.objects.update(deleted=True)
+        archive = tempfile.NamedTemporaryFile(mode='r', suffix='.jsonl')
+        self.addCleanup(archive.close)
+
+        # a chunk whose delete fails is not archived
+        with mock.patch('niuauth.management.commands.purgenotifications.Command._delete',
+                        side_effect=RuntimeError('locked')):
+            with self.assertRaises(RuntimeError):
+                call_command('purgenotifications', chunk=2, archive=archive.name, stdout=StringIO())
+        self.assertEqual(archive.read(), '')
+        self.assertEqual(Notification.objects.count(), 5)
+
+        # every chunk after the first starts past the last id purged
+        with CaptureQueriesContext(connection) as queries:
+            call_command('purgenotifications', chunk=2, archive=archive.name, stdout=StringIO())
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'niuauth_notification' in q['sql']]
+        self.assertEqual(len(selects), 3)
+        for sql in selects[1:]:
+            self.assertIn('"niuauth_notification"."id" > ', sql)
+        self.assertEqual(len(archive.readlines()), 5)
+        self.assertFalse(Notification.objects.exists())
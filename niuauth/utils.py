@@ -1,11 +1,64 @@
+import datetime
 from django.conf import settings
-from niuauth.models import ReputationStat
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from niuauth.models import UserProfile, Notification, ReputationStat, ReputationDaily, ReputationWeekly
 
+def week_of(day):
+    return day - datetime.timedelta(days=day.weekday())
+
+def _add_to_rollup(model, user, amount, **period):
+    rows = model.objects.filter(user=user, **period)
+    if rows.update(amount=F('amount') + amount):
+        return
+    
+    try:
+        with transaction.atomic():
+            model.objects.create(user=user, amount=amount, **period)
+    except IntegrityError:
+        # created by a concurrent reward meanwhile
+        rows.update(amount=F('amount') + amount)
+
+@transaction.atomic
 def user_reward(user, reward_type, topic_id=None, node_id=None):
+    """
+    Add the reward to the user's reputation in a single UPDATE, the profile
+    need not be saved afterwards. The ledger records the total as updated and
+    the day and week rollups are kept in step.
+    """
     amount = settings.REP_GET_SETTING[reward_type]
-    total = user.profile.reputation + amount
+    profiles = UserProfile.objects.filter(user_id=user.id)
+    profiles.update(reputation=F('reputation') + amount)
+    total = profiles.values_list('reputation', flat=True).get()
+    
     stat = ReputationStat(user=user, stat_type=reward_type, amount=amount, total=total,
                           topic_id=topic_id, node_id=node_id)
     stat.save()
     user.profile.reputation = total
+    
+    today = timezone.localdate()
+    _add_to_rollup(ReputationDaily, user, amount, day=today)
+    _add_to_rollup(ReputationWeekly, user, amount, week=week_of(today))
+
+@transaction.atomic
+def mark_read(user):
+    """
+    Mark all the user's notifications read in one UPDATE and take that many
+    off the unread count, a notification arriving meanwhile stays counted.
+    """
+    count = Notification.objects.filter(user_id=user.id, deleted=False, read=False).update(read=True)
+    if count:
+        UserProfile.objects.filter(user_id=user.id).update(unread_count=F('unread_count') - count)
+        user.profile.unread_count = max(user.profile.unread_count - count, 0)
+    
+    return count
 
+@transaction.atomic
+def clear_notifications(user):
+    """
+    Hide all the user's notifications with one UPDATE, the rows are deleted
+    later by the purgenotifications command.
+    """
+    mark_read(user)
+    return Notification.objects.filter(user_id=user.id, deleted=False).update(deleted=True)
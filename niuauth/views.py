@@ -1,17 +1,20 @@
 from django.views.generic.base import TemplateView, View
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, Http404
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.utils.crypto import get_random_string
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import get_object_or_404
+from django.db.models import Prefetch, Subquery, OuterRef, Count, IntegerField
 from niuauth.forms import ProfileForm
 from niuauth.models import Avatar
-from niuauth.utils import user_reward
-from forum.utils import create_thumbnail, get_pagination
+from niuauth.utils import user_reward, mark_read, clear_notifications
+from niuauth.leaderboard import PERIODS, leaderboard
+from forum.models import Topic, Reply
+from forum.utils import get_pagination, topic_pagination
+from forum.jobs import enqueue, avatar_thumbnails
 
 @method_decorator(login_required, name='dispatch')
 class UserProfileView(TemplateView):
@@ -54,16 +57,8 @@ class UserTopicView(TemplateView):
         user = get_object_or_404(User, username=user_id)
         user_topics = user.topics.order_by('-date_created').all()
         
-        paginator = Paginator(user_topics, 10)
         page = self.request.GET.get('page')
-        try:
-            topics = paginator.page(page)
-        except PageNotAnInteger:
-            topics = paginator.page(1)
-        except EmptyPage:
-            topics = paginator.page(paginator.num_pages)
-        
-        page_list = get_pagination(topics.number, paginator.num_pages, 2)
+        topics, page_list = topic_pagination(page, user_topics, 10)
         
         data['see_user'] = user
         data['topics'] = topics
@@ -129,20 +124,30 @@ class SettingsProfileView(TemplateView):
             profile.github = github
             profile.gitlab = gitlab
             
-            profile.save()
+            # reputation and unread_count are updated elsewhere
+            profile.save(update_fields=['avatar', 'profile_init_reward', 'display_name', 'description',
+                                        'website', 'company', 'email', 'location', 'github', 'gitlab',
+                                        'last_modified'])
             
             return HttpResponseRedirect(reverse('settings_profile'))
         
         return super(TemplateView, self).render_to_response(data)
     
     def _save_avatar(self, profile, image):
-        new_name = get_random_string(length=6)
-        ext = image.name.split('.')[-1]
-        image.name = '%s.%s' % (new_name, ext)
-        
-        large, medium, small = create_thumbnail(image, new_name, ext)
-        a = Avatar(avatar_raw=image, avatar_l=large, avatar_m=medium, avatar_s=small)
+        # files are named by their content, a picture uploaded before reuses
+        # the thumbnails made for it then
+        a = Avatar(avatar_raw=image)
         a.save()
+        # a replaced avatar's files may be on their way to gcavatars, only a
+        # live one is sure to keep them
+        done = Avatar.objects.filter(avatar_raw=a.avatar_raw.name, deleted=False).exclude(avatar_s='').first()
+        if done:
+            a.avatar_l, a.avatar_m, a.avatar_s = done.avatar_l, done.avatar_m, done.avatar_s
+            a.save(update_fields=['avatar_l', 'avatar_m', 'avatar_s'])
+        else:
+            # the thumbnails are made by the runjobs worker, until then the
+            # templates fall back to the raw upload or the default avatar
+            enqueue(avatar_thumbnails, avatar_id=a.id)
         
         if profile.has_avatar():
             profile.avatar.deleted = True
@@ -159,7 +164,15 @@ class NotificationView(TemplateView):
     def get_context_data(self, **kwargs):
         data = super(NotificationView, self).get_context_data(**kwargs)
         
-        notifications = self.request.user.notifications.all()
+        # the users, topics and replies a page refers to are fetched in one
+        # query each
+        notifications = self.request.user.notifications.filter(deleted=False).prefetch_related(
+            Prefetch('actor', queryset=User.objects.only('id', 'username')),
+            Prefetch('topic', queryset=Topic.objects.only('id', 'title')),
+            Prefetch('reply', queryset=Reply.objects.only('id', 'topic_id').annotate(seq=Subquery(
+                Reply.objects.filter(topic_id=OuterRef('topic_id'), id__lte=OuterRef('id'))
+                             .order_by().values('topic_id').annotate(seq=Count('id')).values('seq'),
+                output_field=IntegerField()))))
         
         paginator = Paginator(notifications, 10)
         page = self.request.GET.get('page')
@@ -172,12 +185,12 @@ class NotificationView(TemplateView):
         
         page_list = get_pagination(noti_list.number, paginator.num_pages, 2)
         
+        # the page is read before it is marked read, so new ones stand out
+        noti_list.object_list = list(noti_list.object_list)
         data["noti_list"] = noti_list
         data["page_list"] = page_list
         
-        profile = self.request.user.profile
-        profile.has_notification = False
-        profile.save()
+        mark_read(self.request.user)
         
         return data
 
@@ -186,9 +199,26 @@ notification_view = NotificationView.as_view()
 @method_decorator(login_required, name='dispatch')
 class ClearNotificationView(View):
     def get(self, request, *args, **kwargs):
-        self.request.user.notifications.all().delete()
+        clear_notifications(self.request.user)
         
         return HttpResponseRedirect(reverse('notification_view'))
 
 clear_notification_view = ClearNotificationView.as_view()
 
+class LeaderboardView(TemplateView):
+    template_name = "niuauth/leaderboard.html"
+    
+    def get_context_data(self, **kwargs):
+        data = super(LeaderboardView, self).get_context_data(**kwargs)
+        
+        period = self.kwargs.get('period', 'all')
+        if period not in PERIODS:
+            raise Http404
+        
+        data['period'] = period
+        data['periods'] = PERIODS
+        data['board'] = leaderboard(period)
+        
+        return data
+
+leaderboard_view = LeaderboardView.as_view()
@@ -34,7 +34,7 @@ ALLOWED_HOSTS = ['localhost',
 
 INSTALLED_APPS = [
     'niuauth',
-    'forum',
+    'forum.apps.ForumConfig',
     
     'django.contrib.admin',
     'django.contrib.auth',
@@ -53,10 +53,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'forum.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
+    'niuauth.middleware.LegacyBackendMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -94,9 +96,14 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'niuforum.sqlite3'),
+        # the tests run writers in threads, an in-memory database fails them
+        # at once where a file waits for the lock
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_niuforum.sqlite3')},
     }
 }
 
+TEST_RUNNER = 'niuforum.testrunner.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -152,9 +159,11 @@ STATICFILES_DIRS = (
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# same as django's and allauth's backends, the session user comes with its profile;
+# sessions logged in under the plain ones are moved over by LegacyBackendMiddleware
 AUTHENTICATION_BACKENDS = (
-    'django.contrib.auth.backends.ModelBackend',
-    'allauth.account.auth_backends.AuthenticationBackend',
+    'niuauth.backends.ModelBackend',
+    'niuauth.backends.AuthenticationBackend',
 )
 
 LOGIN_REDIRECT_URL = '/'
@@ -224,6 +233,92 @@ REP_GET_SETTING = {
     REP_SPAM: -100
 }
 
+# topic views are buffered in process and written back every interval seconds
+# and at exit, set VIEW_COUNTER_CACHE to a shared cache alias to buffer them
+# there instead, which the flushviewed command can then flush from cron
+VIEW_COUNTER_CACHE = None
+VIEW_COUNTER_FLUSH_INTERVAL = 60
+
+# topic lists page with cached totals, refreshed every timeout seconds
+TOPIC_COUNT_CACHE_TIMEOUT = 300
+
+# rendered markdown is kept in a per process LRU of this many entries, set
+# MARKDOWN_RENDER_CACHE to a cache alias to share renders between processes;
+# texts with @mentions are only cached in the shared cache
+MARKDOWN_RENDER_CACHE_SIZE = 512
+MARKDOWN_RENDER_CACHE = None
+MARKDOWN_RENDER_CACHE_TIMEOUT = 60*60*24
+
+# render markdown in this many worker processes, 0 renders in the request;
+# slower or longer inputs are shown as plain text
+MARKDOWN_RENDER_POOL_SIZE = 0
+MARKDOWN_RENDER_TIMEOUT = 2
+MARKDOWN_MAX_LENGTH = 100000
+
+# notifications and rewards are queued in the forum_job table and run by the
+# runjobs command, a failed job is retried JOB_MAX_ATTEMPTS times, waiting
+# JOB_RETRY_DELAY seconds doubled on each attempt
+JOB_BATCH_SIZE = 100
+JOB_LEASE = 300
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30
+
+# set NODE_TREE_CACHE to a shared cache alias to cache the section/node
+# navigation until a section or node changes, unset it is built for every page
+NODE_TREE_CACHE = None
+NODE_TREE_CACHE_TIMEOUT = 60*60*24
+
+# set PAGE_CACHE to a shared cache alias to cache index, node and topic pages
+# for anonymous visitors, PAGE_CACHE_WAIT is how long a request waits for
+# another one rendering the same page
+PAGE_CACHE = None
+PAGE_CACHE_TIMEOUT = 60*5
+PAGE_CACHE_WAIT = 2
+
+# topics and replies are searched through an sqlite FTS5 table kept up to date
+# by signals, rebuild it with the rebuildsearch command
+SEARCH_TITLE_WEIGHT = 10.0
+SEARCH_SNIPPET_TOKENS = 24
+
+# the reputation leaderboards are ranked again at most every refresh seconds,
+# or whenever the refreshleaderboard command runs
+LEADERBOARD_SIZE = 20
+LEADERBOARD_REFRESH = 60*10
+
+# the default topic order is by a hot score that new topics start at and
+# replies, likes and views add to; the decayhotscores command, run from cron
+# every HOT_SCORE_DECAY_INTERVAL seconds, multiplies it by HOT_SCORE_DECAY and
+# zeroes scores that fall under HOT_SCORE_MIN. Hourly at 0.9 halves a score
+# in about six and a half hours
+HOT_SCORE_TOPIC = 10.0
+HOT_SCORE_REPLY = 3.0
+HOT_SCORE_LIKE = 5.0
+HOT_SCORE_VIEW = 0.1
+HOT_SCORE_DECAY = 0.9
+HOT_SCORE_DECAY_INTERVAL = 60*60
+HOT_SCORE_MIN = 0.01
+
+# cleared notifications, and any older than the retention period, are deleted
+# by the purgenotifications command in chunks of this many rows
+NOTIFICATION_RETENTION_DAYS = 90
+NOTIFICATION_PURGE_CHUNK = 500
+
+# uploaded avatars and node icons with more pixels than this are refused
+THUMBNAIL_MAX_PIXELS = 40*1000*1000
+
+# avatars and node icons are named by their content, so their URLs can be
+# cached for this long
+HASHED_MEDIA_MAX_AGE = 60*60*24*365
+
+# set PROFILING to time SQL, templates, markdown and thumbnails of every
+# request, the times go out as Server-Timing headers and into request.log;
+# PROFILING_SAMPLE_RATE of the requests also run under cProfile and the
+# slowest PROFILING_KEEP of them per process are dumped to PROFILING_DIR
+PROFILING = False
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_KEEP = 20
+PROFILING_DIR = os.path.join(BASE_DIR, "logs")
+
 USER_CREATE_TOPIC = 1
 REP_NEED_SETTING = {
     USER_CREATE_TOPIC: 10,
@@ -0,0 +1,9 @@
+from django.test.runner import DiscoverRunner
+from forum.viewcounter import view_counter
+
+class TestRunner(DiscoverRunner):
+    def teardown_databases(self, old_config, **kwargs):
+        # views the tests buffered would be written at exit, after the test
+        # database is gone
+        view_counter.flush()
+        super(TestRunner, self).teardown_databases(old_config, **kwargs)
@@ -20,6 +20,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 import niuauth.views
 import forum.views
+import forum.storage
 
 urlpatterns = [
     url(r'^$', forum.views.forum_index, name='forum_index'),
@@ -33,6 +34,7 @@ urlpatterns = [
     url(r'^topics/add/$', forum.views.create_topic_view, name='create_topic_view'),
     url(r'^topics/add/(?P<node_id>\d+)/$', forum.views.create_topic_view, name='create_topic_view'),
     url(r'^topics/update/(?P<topic_id>\d+)/$', forum.views.update_topic_view, name='update_topic_view'),
+    url(r'^search/$', forum.views.search_view, name='search_view'),
     
     url(r'^action/watch-node/(?P<node_id>\d+)/$', forum.views.watch_node_view, name='watch_node_view'),
     url(r'^action/like-topic/(?P<topic_id>\d+)/$', forum.views.like_topic_view, name='like_topic_view'),
@@ -44,7 +46,9 @@ urlpatterns = [
     url(r'^settings/profile/$', niuauth.views.settings_profile, name='settings_profile'),
     url(r'^notification/$', niuauth.views.notification_view, name='notification_view'),
     url(r'^notification/clear/$', niuauth.views.clear_notification_view, name='clear_notification_view'),
+    url(r'^leaderboard/$', niuauth.views.leaderboard_view, name='leaderboard'),
+    url(r'^leaderboard/(?P<period>\w+)/$', niuauth.views.leaderboard_view, name='leaderboard'),
     
     url(r'^accounts/', include('allauth.urls')),
     url(r'^admin/', admin.site.urls),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+] + static(settings.MEDIA_URL, view=forum.storage.serve_media, document_root=settings.MEDIA_ROOT)